@@ -57,7 +57,7 @@ from data import invalid_txs
 #  For now, it is used to serialize a bloated varint (b64).
 class CBrokenBlock(CBlock):
     def initialize(self, base_block):
-        self.vtx = copy.deepcopy(base_block.vtx)
+        self.vtx = [tx.clone() for tx in base_block.vtx]
         self.hashMerkleRoot = self.calc_merkle_root()
 
     def serialize(self, with_witness=False):
@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Microbenchmarks for the test_framework modules.
+
+This is not a test script and does not need a bitcoind. Run it with no
+arguments to run every benchmark, or name the benchmarks to run:
+
+    test/functional/framework_bench.py uint256
+"""
+
+import argparse
+import asyncio
+from contextlib import contextmanager
+import copy
+import logging
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from test_framework import siphash
+from test_framework.blocktools import HeaderChain, create_block, create_coinbase
+from test_framework.key import (
+    ECKey,
+    SECP256K1,
+    SECP256K1_ORDER,
+    SignatureCache,
+    get_pubkeys,
+    sign_ecdsa_batch,
+    verify_ecdsa_batch,
+)
+from test_framework.p2p_capture import MessageCapture
+from test_framework.messages import (
+    BytesReader,
+    CBlock,
+    CBlockHeader,
+    CInv,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxInWitness,
+    CTxOut,
+    HeaderAndShortIDs,
+    MSG_TX,
+    MSG_WITNESS_FLAG,
+    TxBatch,
+    calculate_shortid,
+    deser_uint256_vector,
+    deser_vector,
+    msg_block,
+    msg_getdata,
+    msg_getheaders,
+    msg_headers,
+    msg_ping,
+    msg_tx,
+    ser_uint256,
+    ser_uint256_vector,
+    uint256_from_str,
+)
+from test_framework.mininode import (
+    FramedMessageCache,
+    MAGIC_BYTES,
+    MAX_HEADERS_RESULTS,
+    NetworkThread,
+    NetworkThreadPool,
+    mininode_lock,
+    P2PConnection,
+    P2PDataStore,
+    P2PInterface,
+)
+from test_framework.script import CScript, LegacySignatureHash, OP_CHECKSIG, SIGHASH_ALL
+from test_framework.util import wait_until
+from test_framework.wallet_util import generate_key_pairs, get_generate_key
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+
+def timed(fn, *args):
+    """Return the best wall clock time of fn(*args) over the configured repeats."""
+    best = None
+    for _ in range(timed.repeat):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+timed.repeat = 3
+
+
+def report(label, seconds, count=None, baseline=None):
+    line = "  %-36s %8.4fs" % (label, seconds)
+    if count is not None:
+        line += "  %12.0f/s" % (count / seconds)
+    if baseline is not None:
+        line += "  %5.1fx" % (baseline / seconds)
+    print(line)
+
+
+@benchmark("uint256")
+def bench_uint256(n=50000):
+    """uint256 conversions on a 50,000 entry inv/getdata vector."""
+
+    # The per-word struct loops these helpers used to be built on
+    def ser_uint256_words(u):
+        rs = b""
+        for i in range(8):
+            rs += struct.pack("<I", u & 0xFFFFFFFF)
+            u >>= 32
+        return rs
+
+    def uint256_from_words(s):
+        r = 0
+        t = struct.unpack("<IIIIIIII", s[:32])
+        for i in range(8):
+            r += t[i] << (i * 32)
+        return r
+
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(256) for _ in range(n)]
+    raw = [ser_uint256(h) for h in hashes]
+    vector = ser_uint256_vector(hashes)
+
+    base = timed(lambda: [ser_uint256_words(h) for h in hashes])
+    report("ser_uint256 (struct loop)", base, n)
+    report("ser_uint256", timed(lambda: [ser_uint256(h) for h in hashes]), n, base)
+    report("ser_uint256_vector", timed(ser_uint256_vector, hashes), n, base)
+
+    base = timed(lambda: [uint256_from_words(s) for s in raw])
+    report("uint256_from_str (struct loop)", base, n)
+    report("uint256_from_str", timed(lambda: [uint256_from_str(s) for s in raw]), n, base)
+    report("deser_uint256_vector", timed(lambda: deser_uint256_vector(BytesReader(vector))), n, base)
+
+    msg = msg_getdata([CInv(MSG_TX | MSG_WITNESS_FLAG, h) for h in hashes])
+    payload = msg.serialize()
+    report("msg_getdata.serialize", timed(msg.serialize), n)
+    base = timed(lambda: deser_vector(BytesReader(payload), CInv))
+    report("deser_vector(CInv)", base, n)
+    report("msg_getdata.deserialize", timed(lambda: msg_getdata().deserialize(BytesReader(payload))), n, base)
+
+
+@benchmark("txbatch")
+def bench_txbatch(n=100000):
+    """Build, serialize and hash 100,000 transactions as CTransactions and as a TxBatch."""
+    script = bytes(22)
+
+    def build_ctransactions():
+        txs = []
+        for i in range(n):
+            tx = CTransaction()
+            tx.vin.append(CTxIn(COutPoint(i, 0), b"", 0xffffffff))
+            tx.vout.append(CTxOut(1000, script))
+            tx.vout.append(CTxOut(2000, script))
+            txs.append(tx)
+        return txs
+
+    def build_batch():
+        batch = TxBatch()
+        for i in range(n):
+            batch.add_transaction()
+            batch.add_input(i, 0, b"", 0xffffffff)
+            batch.add_output(1000, script)
+            batch.add_output(2000, script)
+        return batch
+
+    for label, build, to_hex, txids in (
+        ("CTransaction", build_ctransactions, lambda txs: [tx.serialize().hex() for tx in txs],
+         lambda txs: [tx.rehash() for tx in txs]),
+        ("TxBatch", build_batch, TxBatch.to_hex, TxBatch.calc_sha256),
+    ):
+        tracemalloc.start()
+        start = time.perf_counter()
+        txs = build()
+        built = time.perf_counter()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report("%s build" % label, built - start, n)
+        report("%s to hex" % label, timed(to_hex, txs), n)
+        report("%s txids" % label, timed(txids, txs), n)
+        print("  %-36s %8.1fMB" % ("%s memory" % label, memory / 1e6))
+        del txs
+
+
+@benchmark("clone")
+def bench_clone(inputs=50):
+    """Copying a 50 input transaction, and signature hashing every one of its inputs."""
+    script = CScript([bytes(33), OP_CHECKSIG])
+    tx = CTransaction()
+    for i in range(inputs):
+        tx.vin.append(CTxIn(COutPoint(i, 0), bytes(107), 0xffffffff))
+        tx.wit.vtxinwit.append(CTxInWitness())
+        tx.wit.vtxinwit[i].scriptWitness.stack = [bytes(72), bytes(33)]
+        tx.vout.append(CTxOut(1000, bytes(22)))
+    n = 200
+
+    base = timed(lambda: [copy.deepcopy(tx) for _ in range(n)])
+    report("copy.deepcopy", base, n)
+    report("CTransaction.clone", timed(lambda: [tx.clone() for _ in range(n)]), n, base)
+    report("LegacySignatureHash", timed(lambda: [LegacySignatureHash(script, tx, i, SIGHASH_ALL) for i in range(inputs)]), inputs)
+
+
+@benchmark("framing")
+def bench_framing(peers=8):
+    """Framing a 1MB block once for each of 8 peers, with and without a FramedMessageCache."""
+    block = CBlock()
+    for i in range(2000):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(i, 0), bytes(400)))
+        tx.vout.append(CTxOut(1000, bytes(100)))
+        block.vtx.append(tx)
+    msg = msg_block(block)
+    conns = [P2PConnection() for _ in range(peers)]
+    for conn in conns:
+        conn.magic_bytes = MAGIC_BYTES["regtest"]
+
+    def send_to_all():
+        for conn in conns:
+            conn.build_message(msg)
+
+    base = timed(send_to_all)
+    report("build_message", base, peers)
+    P2PConnection.message_cache = FramedMessageCache()
+    report("build_message (cached)", timed(send_to_all), peers, base)
+    P2PConnection.message_cache = None
+
+
+@benchmark("shortids")
+def bench_shortids(n=5000):
+    """Compact block short IDs for 5,000 transactions, one at a time and batched."""
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(256) for _ in range(n)]
+    k0, k1 = rng.getrandbits(64), rng.getrandbits(64)
+
+    base = timed(lambda: [calculate_shortid(k0, k1, h) for h in hashes])
+    report("calculate_shortid", base, n)
+    report("siphash256_batch (python)", timed(siphash.siphash256_batch, k0, k1, hashes, False), n, base)
+    if siphash.numpy is not None:
+        report("siphash256_batch (numpy)", timed(siphash.siphash256_batch, k0, k1, hashes, True), n, base)
+    else:
+        print("  siphash256_batch (numpy)             skipped, numpy is not installed")
+
+    block = CBlock()
+    for i in range(n):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(i, 0)))
+        tx.rehash()
+        block.vtx.append(tx)
+    report("initialize_from_block", timed(lambda: HeaderAndShortIDs().initialize_from_block(block)), n)
+
+
+@benchmark("recv")
+def bench_recv(n=100000):
+    """Receiving a stream of 100,000 ping messages, all at once and in 4kB reads."""
+
+    class CountingConnection(P2PConnection):
+        def on_message(self, message):
+            self.received += 1
+
+    def receive(stream, chunk_size, capture_path=None):
+        conn = CountingConnection()
+        if capture_path is not None:
+            conn.capture = MessageCapture(capture_path)
+        conn.dstaddr, conn.dstport = "127.0.0.1", 0
+        conn.magic_bytes = MAGIC_BYTES["regtest"]
+        conn.recvbuf = bytearray()
+        conn.recvbuf_pos = 0
+        conn.received = 0
+        for i in range(0, len(stream), chunk_size):
+            conn.data_received(stream[i:i + chunk_size])
+        assert conn.received == n
+        if conn.capture is not None:
+            conn.capture.close()
+
+    framer = P2PConnection()
+    framer.magic_bytes = MAGIC_BYTES["regtest"]
+    stream = b"".join([framer.build_message(msg_ping(i)) for i in range(n)])
+    report("data_received (single read)", timed(receive, stream, len(stream)), n)
+    base = timed(receive, stream, 4096)
+    report("data_received (4kB reads)", base, n)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        capture_path = os.path.join(tmpdir, "capture.bin")
+        # Includes writing the rest of the capture file when it's closed
+        report("data_received (4kB reads, captured)", timed(receive, stream, 4096, capture_path), n, base)
+
+
+@benchmark("logging")
+def bench_logging(n=2000):
+    """Logging a received block of 2,000 transactions."""
+    block = CBlock()
+    for i in range(n):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(i, 0), b"\x01" * 100))
+        tx.vout.append(CTxOut(i, b"\x51" * 25))
+        block.vtx.append(tx)
+    msg = msg_block(block)
+    conn = P2PConnection()
+    conn.dstaddr, conn.dstport = "127.0.0.1", 0
+
+    logger = logging.getLogger("TestFramework.mininode")
+    level, propagate = logger.level, logger.propagate
+    handler = logging.NullHandler()
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        logger.setLevel(logging.DEBUG)
+        base = timed(lambda: logger.debug("Received message from %s:%d: %s" % (conn.dstaddr, conn.dstport, repr(msg)[:500])))
+        report("repr(msg)[:500]", base)
+        report("_log_message", timed(conn._log_message, "receive", msg), None, base)
+        logger.setLevel(logging.INFO)
+        report("_log_message (debug disabled)", timed(conn._log_message, "receive", msg), None, base)
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = propagate
+
+
+@benchmark("headers")
+def bench_headers(n=10000):
+    """Building a chain of 10,000 regtest headers and its headers messages."""
+
+    def build_blocks():
+        prev_hash = 0
+        headers = []
+        for height in range(1, n + 1):
+            block = create_block(prev_hash, create_coinbase(height), height, version=4)
+            block.solve()
+            headers.append(CBlockHeader(block))
+            prev_hash = block.sha256
+        return [msg_headers(headers[i:i + MAX_HEADERS_RESULTS]).serialize() for i in range(0, n, MAX_HEADERS_RESULTS)]
+
+    def build_chain():
+        chain = HeaderChain(0, 0, 0)
+        chain.extend(n)
+        return [msg.serialize() for msg in chain.headers_messages()]
+
+    assert build_blocks() == build_chain()
+    base = timed(build_blocks)
+    report("create_block, solve, msg_headers", base, n)
+    report("HeaderChain", timed(build_chain), n, base)
+
+
+@benchmark("ecdsa")
+def bench_ecdsa(n=200):
+    """Generating 200 public keys, and signing and verifying 200 messages."""
+
+    # The double-and-add multiplication key.py used to do
+    def double_and_add(ps):
+        r = (0, 1, 0)
+        for i in range(255, -1, -1):
+            r = SECP256K1.double(r)
+            for (p, k) in ps:
+                if (k >> i) & 1:
+                    r = SECP256K1.add(r, p)
+        return r
+
+    rng = random.Random(0)
+    keys = []
+    for i in range(n):
+        key = ECKey()
+        key.set(rng.getrandbits(256).to_bytes(32, "big"), True)
+        keys.append(key)
+    msgs = [rng.getrandbits(256).to_bytes(32, "big") for _ in range(n)]
+    pubkeys = [key.get_pubkey() for key in keys]
+    sigs = [key.sign_ecdsa(msg) for key, msg in zip(keys, msgs)]
+
+    def with_double_and_add(fn):
+        # Shadow the method on the curve instance
+        SECP256K1.mul = double_and_add
+        try:
+            fn()
+        finally:
+            del SECP256K1.mul
+
+    def derive_pubkeys_serially():
+        return [key.get_pubkey() for key in keys]
+
+    def sign():
+        return [key.sign_ecdsa(msg) for key, msg in zip(keys, msgs)]
+
+    def verify():
+        return [pubkey.verify_ecdsa(sig, msg) for pubkey, sig, msg in zip(pubkeys, sigs, msgs)]
+
+    for label, fn, batch_label, batch_fn in [
+        ("get_pubkey", derive_pubkeys_serially, None, None),
+        ("sign_ecdsa", sign, "sign_ecdsa_batch", lambda: sign_ecdsa_batch(list(zip(keys, msgs)))),
+        ("verify_ecdsa", verify, "verify_ecdsa_batch", lambda: verify_ecdsa_batch(zip(pubkeys, sigs, msgs))),
+    ]:
+        base = timed(with_double_and_add, fn)
+        report(label + " (double-and-add)", base, n)
+        report(label, timed(fn), n, base)
+        if batch_fn is not None:
+            report(batch_label, timed(batch_fn), n, base)
+
+
+@benchmark("pubkeys")
+def bench_pubkeys(n=10000):
+    """Deriving 10,000 serialized public keys."""
+    rng = random.Random(0)
+    keys = []
+    for _ in range(n):
+        key = ECKey()
+        key.set(rng.randrange(1, SECP256K1_ORDER).to_bytes(32, "big"), True)
+        keys.append(key)
+
+    base = timed(lambda: [key.get_pubkey().get_bytes() for key in keys])
+    report("get_pubkey().get_bytes()", base, n)
+    report("get_pubkeys()", timed(lambda: [pubkey.get_bytes() for pubkey in get_pubkeys(keys)]), n, base)
+
+
+@benchmark("sigcache")
+def bench_sigcache(n=500):
+    """Signing 500 messages deterministically, and again from a signature cache."""
+    rng = random.Random(0)
+    keys_and_msgs = []
+    for _ in range(n):
+        key = ECKey()
+        key.set(rng.randrange(1, SECP256K1_ORDER).to_bytes(32, "big"), True)
+        keys_and_msgs.append((key, rng.getrandbits(256).to_bytes(32, "big")))
+
+    sign = lambda rfc6979: [key.sign_ecdsa(msg, rfc6979=rfc6979) for key, msg in keys_and_msgs]
+    base = timed(sign, False)
+    report("sign_ecdsa()", base, n)
+    report("sign_ecdsa(rfc6979=True)", timed(sign, True), n, base)
+    ECKey.signature_cache = SignatureCache()
+    try:
+        sign(True)
+        report("sign_ecdsa(rfc6979=True), cached", timed(sign, True), n, base)
+    finally:
+        ECKey.signature_cache = None
+
+
+@benchmark("keypairs")
+def bench_keypairs(n=2000):
+    """Generating 2,000 key pairs with their legacy, p2sh-segwit and bech32 addresses."""
+    seed = bytes(32)
+    base = timed(lambda: [get_generate_key() for _ in range(n)])
+    report("get_generate_key()", base, n)
+    report("generate_key_pairs()", timed(generate_key_pairs, n, seed), n, base)
+    processes = os.cpu_count() or 1
+    report("generate_key_pairs(processes=%d)" % processes,
+           timed(lambda: generate_key_pairs(n, seed, processes=processes, chunk_size=250)), n, base)
+
+
+@contextmanager
+def local_peer(conn, peer_class=P2PInterface):
+    """Start a network thread, and connect conn to a peer_class instance listening on localhost.
+
+    Yields the peer."""
+    network_thread = NetworkThreadPool()
+    network_thread.start()
+    loop = NetworkThread.network_event_loop
+    peers = []
+
+    def serve():
+        peer = peer_class()
+        peer.dstaddr, peer.dstport = "127.0.0.1", 0
+        peer.magic_bytes = MAGIC_BYTES["regtest"]
+        peer.recvbuf = bytearray()
+        peer.recvbuf_pos = 0
+        peer.on_connection_send_msg = None
+        peer._loop = loop
+        peers.append(peer)
+        return peer
+
+    try:
+        server = asyncio.run_coroutine_threadsafe(loop.create_server(serve, "127.0.0.1", 0), loop).result()
+        conn.peer_connect("127.0.0.1", server.sockets[0].getsockname()[1], net="regtest", send_version=False)()
+        wait_until(lambda: conn.is_connected and peers, timeout=10)
+        yield peers[0]
+        conn.peer_disconnect()
+        loop.call_soon_threadsafe(server.close)
+    finally:
+        network_thread.close()
+
+
+@benchmark("ping")
+def bench_ping(n=200):
+    """200 sync_with_ping() round trips to a local peer that answers pings."""
+    conn = P2PInterface()
+    with local_peer(conn):
+        def ping():
+            for _ in range(n):
+                conn.sync_with_ping()
+
+        report("sync_with_ping", timed(ping), n)
+
+
+@benchmark("send")
+def bench_send(n=10000):
+    """Sending 10,000 transactions to a local peer."""
+    txs = []
+    for i in range(n):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(i, 0), b"\x01" * 100))
+        tx.vout.append(CTxOut(i, b"\x51" * 25))
+        txs.append(tx)
+
+    def send(send_all):
+        conn = P2PInterface()
+        with local_peer(conn) as peer:
+            send_all(conn)
+            wait_until(lambda: peer.message_count["tx"] == n, timeout=60, lock=mininode_lock)
+
+    def send_one_by_one(conn):
+        for tx in txs:
+            conn.send_message(msg_tx(tx))
+
+    base = timed(send, send_one_by_one)
+    report("send_message", base, n)
+    report("send_messages", timed(send, lambda conn: conn.send_messages(msg_tx(tx) for tx in txs)), n, base)
+
+
+@benchmark("getheaders")
+def bench_getheaders(n=100000):
+    """Serving a 100,000 block chain to a syncing node, 2,000 headers at a time."""
+
+    # The walk back from the tip that on_getheaders used to do
+    def walk_back(store, locator, hash_stop):
+        headers_list = [store.block_store[store.last_block_hash]]
+        while headers_list[-1].sha256 not in locator.vHave:
+            prev_block_hash = headers_list[-1].hashPrevBlock
+            if prev_block_hash in store.block_store:
+                prev_block_header = CBlockHeader(store.block_store[prev_block_hash])
+                headers_list.append(prev_block_header)
+                if prev_block_header.sha256 == hash_stop:
+                    break
+            else:
+                break
+        store.send_message(msg_headers(headers_list[:-MAX_HEADERS_RESULTS - 1:-1]))
+
+    store = P2PDataStore()
+    prev = 0
+    for i in range(n):
+        block = CBlock()
+        block.hashPrevBlock = prev
+        block.nNonce = i
+        block.rehash()
+        store.store_block(block)
+        prev = block.sha256
+
+    def sync(handler):
+        # Request headers the way a node does, with the last received header
+        # first in the locator
+        sent = []
+        store.send_message = sent.append
+        request = msg_getheaders()
+        request.locator.vHave = [0]
+        while True:
+            handler(request)
+            if sent[-1].headers[-1].sha256 == store.last_block_hash:
+                break
+            request.locator.vHave = [sent[-1].headers[-1].sha256, store.active_chain[0]]
+
+    base = timed(sync, lambda request: walk_back(store, request.locator, request.hashstop))
+    report("walk back from the tip", base, n)
+    report("P2PDataStore.on_getheaders", timed(sync, store.on_getheaders), n, base)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmarks', nargs='*', help="benchmarks to run (default: all of %s)" % ", ".join(sorted(BENCHMARKS)))
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each measurement; the best time is reported")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ", ".join(unknown))
+    timed.repeat = args.repeat
+
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print("%s: %s" % (name, BENCHMARKS[name].__doc__.split("\n")[0]))
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Tests for test_framework.key and the bulk key generation in wallet_util."""
+
+import hashlib
+import os
+import random
+
+from test_framework.key import (
+    ECKey,
+    SECP256K1,
+    SECP256K1_G,
+    SECP256K1_ORDER,
+    SignatureCache,
+    encode_der_signature,
+    get_pubkeys,
+    modinv_all,
+    parse_der_signature,
+    rfc6979_nonce,
+    sign_ecdsa_batch,
+    verify_ecdsa_batch,
+    wnaf,
+)
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import assert_equal, assert_raises
+from test_framework.wallet_util import generate_key_pairs
+
+def test_ecc_mul():
+    def double_and_add(ps):
+        r = (0, 1, 0)
+        for i in range(255, -1, -1):
+            r = SECP256K1.double(r)
+            for (p, n) in ps:
+                if (n >> i) & 1:
+                    r = SECP256K1.add(r, p)
+        return SECP256K1.affine(r)
+
+    for n in [1, 0xffff, 0xb3c4 << 200]:
+        digits = wnaf(n, 5)
+        assert_equal(sum(d << i for i, d in enumerate(digits)), n)
+        assert all(d == 0 or (d & 1 and abs(d) < 16) for d in digits)
+        assert all(sum(d != 0 for d in digits[i:i + 5]) <= 1 for i in range(len(digits)))
+
+    rng = random.Random(0)
+    p = SECP256K1.mul([(SECP256K1_G, rng.randrange(1, SECP256K1_ORDER))])
+    for n in [0, 1, 255, 256, SECP256K1_ORDER - 1, rng.randrange(SECP256K1_ORDER)]:
+        m = rng.randrange(SECP256K1_ORDER)
+        for ps in [[(SECP256K1_G, n)], [(p, n)], [(SECP256K1_G, n), (p, m)], [(p, n), (SECP256K1.double(p), m)]]:
+            assert_equal(SECP256K1.affine(SECP256K1.mul(ps)), double_and_add(ps))
+
+    key = ECKey()
+    key.generate()
+    pubkey = key.get_pubkey()
+    sig = key.sign_ecdsa(b"\x01" * 32)
+    assert pubkey.verify_ecdsa(sig, b"\x01" * 32)
+    assert not pubkey.verify_ecdsa(sig, b"\x02" * 32)
+
+def test_batch_affine():
+    points = [SECP256K1.mul([(SECP256K1_G, n)]) for n in [5, 0, 7, SECP256K1_ORDER - 1]]
+    assert_equal(SECP256K1.batch_affine(points), [SECP256K1.affine(p) for p in points])
+    assert_equal(SECP256K1.batch_affine([(0, 1, 0)]), [None])
+    assert_equal(SECP256K1.batch_affine([]), [])
+
+    keys = []
+    for compressed in [True, False]:
+        key = ECKey()
+        key.generate(compressed)
+        keys.append(key)
+    assert_equal([pubkey.get_bytes() for pubkey in get_pubkeys(keys)], [key.get_pubkey().get_bytes() for key in keys])
+    assert_raises(AssertionError, get_pubkeys, keys + [ECKey()])
+
+def test_ecdsa_batch():
+    assert_equal(modinv_all([3, 5, 7], 11), [4, 9, 8])
+    keys = []
+    for i in range(10):
+        key = ECKey()
+        key.generate(compressed=bool(i & 1))
+        keys.append(key)
+    msgs = [bytes([i]) * 32 for i in range(10)]
+    pubkeys = [key.get_pubkey() for key in keys]
+    for processes in [None, 2]:
+        sigs = sign_ecdsa_batch(list(zip(keys, msgs)), processes=processes)
+        assert all(pubkey.verify_ecdsa(sig, msg) for pubkey, sig, msg in zip(pubkeys, sigs, msgs))
+        # Wrong message, bad DER encoding, high s
+        r, s = parse_der_signature(sigs[2])
+        tests = list(zip(pubkeys, sigs, msgs))
+        tests[1] = (pubkeys[1], sigs[1], msgs[0])
+        tests[2] = (pubkeys[2], sigs[2][:-1], msgs[2])
+        tests[3] = (pubkeys[2], encode_der_signature(r, SECP256K1_ORDER - s), msgs[2])
+        assert_equal(verify_ecdsa_batch(tests, processes=processes), [True, False, False, False] + [True] * 6)
+        assert_equal(verify_ecdsa_batch(tests, low_s=False, processes=processes), [True, False, False, True] + [True] * 6)
+
+def test_rfc6979(tmpdir):
+    # Test vector from https://bitcointalk.org/index.php?topic=285142.40
+    key = ECKey()
+    key.set((1).to_bytes(32, 'big'), True)
+    msg = hashlib.sha256(b"Satoshi Nakamoto").digest()
+    assert_equal(rfc6979_nonce(key.get_bytes(), msg), 0x8F8A276C19F4149656B280621E358CCE24F5F52542772691EE69063B74F15D15)
+    sig = bytes.fromhex("3045022100934b1ea10a4b3c1757e2b0c017d0b6143ce3c9a7e6a4a49860d7a6ab210ee3d802202442ce9d2b916064108014783e923ec36b49743e2ffa1c4496f01a512aafd9e5")
+    assert_equal(key.sign_ecdsa(msg, rfc6979=True), sig)
+    assert_equal(sign_ecdsa_batch([(key, msg)], rfc6979=True), [sig])
+    assert key.sign_ecdsa(msg) != key.sign_ecdsa(msg)
+
+    path = os.path.join(tmpdir, "signatures")
+    ECKey.signature_cache = cache = SignatureCache(path)
+    try:
+        assert_equal(key.sign_ecdsa(msg, rfc6979=True), sig)
+        assert_equal(key.sign_ecdsa(msg, rfc6979=True), sig)
+        key.sign_ecdsa(msg, low_s=False, rfc6979=True)
+        key.sign_ecdsa(msg)
+        assert_equal((cache.hits, cache.misses, len(cache)), (1, 2, 2))
+        cache.save()
+        # A different key with the same message isn't a hit
+        other = ECKey()
+        other.set((2).to_bytes(32, 'big'), True)
+        ECKey.signature_cache = cache = SignatureCache(path)
+        assert_equal(len(cache), 2)
+        assert_equal(key.sign_ecdsa(msg, rfc6979=True), sig)
+        assert other.get_pubkey().verify_ecdsa(other.sign_ecdsa(msg, rfc6979=True), msg)
+        assert_equal((cache.hits, cache.misses), (1, 1))
+    finally:
+        ECKey.signature_cache = None
+
+def test_generate_key_pairs():
+    seed = bytes(range(32))
+    keys = generate_key_pairs(10, seed)
+    assert_equal(len(keys), 10)
+    assert_equal(len(keys.secrets), 320)
+    assert_equal(len(keys.pubkeys), 330)
+    # The keys don't depend on how they're split up
+    for processes, chunk_size in [(None, 3), (2, 4)]:
+        assert_equal(vars(generate_key_pairs(10, seed, processes=processes, chunk_size=chunk_size)), vars(keys))
+    assert generate_key_pairs(10).secrets != keys.secrets
+    for i in range(10):
+        eckey = keys.get_eckey(i)
+        assert_equal(eckey.get_pubkey().get_bytes(), keys.get_pubkey(i))
+        key = keys.get_key(i)
+        assert_equal((key.p2pkh_addr, key.p2sh_p2wpkh_addr, key.p2wpkh_addr),
+                     (keys.p2pkh_addrs[i], keys.p2sh_p2wpkh_addrs[i], keys.p2wpkh_addrs[i]))
+
+class FrameworkTestKey(BitcoinTestFramework):
+    def setup_network(self):
+        pass
+
+    def set_test_params(self):
+        self.num_nodes = 0
+
+    def run_test(self):
+        test_ecc_mul()
+        test_batch_affine()
+        test_ecdsa_batch()
+        test_rfc6979(self.options.tmpdir)
+        test_generate_key_pairs()
+
+if __name__ == '__main__':
+    FrameworkTestKey().main()
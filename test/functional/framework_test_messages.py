@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Tests for test_framework.messages, blocktools and siphash."""
+
+from io import BytesIO
+
+from test_framework import siphash
+from test_framework.blocktools import HeaderChain, create_block, create_coinbase
+from test_framework.messages import (
+    BytesReader,
+    CBlock,
+    CInv,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxInWitness,
+    CTxOut,
+    FromHex,
+    MerkleTree,
+    TxBatch,
+    deser_uint256_vector,
+    hash256,
+    msg_block,
+    msg_getdata,
+    msg_headers,
+    msg_lazy_block,
+    repr_truncated,
+    ser_uint256,
+    ser_uint256_vector,
+    uint256_from_str,
+)
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import assert_equal
+
+def test_bytes_reader():
+    tx = CTransaction()
+    tx.vin.append(CTxIn(COutPoint(0xdeadbeef, 1), b"\x51" * 300, 0xfffffffe))
+    tx.vout.append(CTxOut(5000, b"\x00\x14" + b"\x11" * 20))
+    tx.wit.vtxinwit.append(CTxInWitness())
+    tx.wit.vtxinwit[0].scriptWitness.stack = [b"\x01" * 72, b""]
+    raw = tx.serialize()
+
+    # Decoding through a BytesReader, a BytesIO or FromHex gives the same transaction
+    from_reader = CTransaction()
+    reader = BytesReader(raw + b"\xff")
+    from_reader.deserialize(reader)
+    assert_equal(reader.tell(), len(raw))
+    from_stream = CTransaction()
+    from_stream.deserialize(BytesIO(raw))
+    for decoded in (from_reader, from_stream, FromHex(CTransaction(), raw.hex())):
+        assert_equal(decoded.serialize(), raw)
+        assert_equal(decoded.rehash(), tx.rehash())
+
+def test_serialize_into():
+    tx = CTransaction()
+    tx.vin.append(CTxIn(COutPoint(1, 2), b"\x00" * 260))
+    tx.vout.append(CTxOut(1, b"\x51"))
+    block = CBlock()
+    block.vtx = [tx] * 3
+
+    # serialize_into() appends to the buffer it is given
+    for obj in (tx, block, msg_headers([block])):
+        buf = bytearray(b"prefix")
+        assert obj.serialize_into(buf) is buf
+        assert_equal(bytes(buf), b"prefix" + obj.serialize())
+    assert_equal(block.serialize(), super(CBlock, block).serialize() + b"\x03" + tx.serialize() * 3)
+    assert_equal(msg_headers([block]).serialize(), b"\x01" + super(CBlock, block).serialize() + b"\x00")
+
+def test_tx_cache():
+    tx = CTransaction()
+    tx.vin.append(CTxIn(COutPoint(1, 0)))
+    tx.vout.append(CTxOut(1000, b"\x51"))
+    txid = tx.rehash()
+    wtxid = tx.calc_sha256(with_witness=True)
+    assert tx.serialize_without_witness() is tx.serialize_without_witness()
+
+    # Mutating any nested field invalidates the cached serialization and hashes
+    tx.vin[0].prevout.n = 1
+    assert txid != tx.rehash()
+    tx.wit.vtxinwit.append(CTxInWitness())
+    tx.wit.vtxinwit[0].scriptWitness.stack.append(b"\x01")
+    assert wtxid != tx.calc_sha256(with_witness=True)
+    assert_equal(tx.calc_sha256(with_witness=True), FromHex(CTransaction(), tx.serialize().hex()).calc_sha256(with_witness=True))
+
+    # So does changing a bytearray script or witness item in place
+    tx.vin[0].scriptSig = bytearray(b"\x51")
+    txid = tx.rehash()
+    tx.vin[0].scriptSig[0] = 0x52
+    assert txid != tx.rehash()
+    assert_equal(tx.serialize_without_witness(), FromHex(CTransaction(), tx.serialize().hex()).serialize_without_witness())
+    tx.wit.vtxinwit[0].scriptWitness.stack[0] = bytearray(b"\x01")
+    wtxid = tx.calc_sha256(with_witness=True)
+    tx.wit.vtxinwit[0].scriptWitness.stack[0][0] = 0x02
+    assert wtxid != tx.calc_sha256(with_witness=True)
+
+    # Overriding the serialization in a subclass changes the txid and the
+    # serialization inside a block
+    class PaddedTransaction(CTransaction):
+        def serialize_without_witness(self):
+            return super().serialize_without_witness() + b"\x00"
+
+    padded = PaddedTransaction(tx)
+    padded.rehash()
+    assert_equal(padded.sha256, uint256_from_str(hash256(tx.serialize_without_witness() + b"\x00")))
+    block = CBlock()
+    block.vtx = [padded]
+    assert_equal(len(block.serialize(with_witness=False)), 80 + 1 + len(tx.serialize_without_witness()) + 1)
+
+def test_merkle_tree():
+    leaves = [hash256(bytes([i])) for i in range(7)]
+    tree = MerkleTree(leaves[:5])
+    assert_equal(tree.root(), CBlock.get_merkle_root(leaves[:5]))
+    tree.update(leaves)
+    assert_equal(tree.root(), CBlock.get_merkle_root(leaves))
+    leaves[3] = hash256(b"replaced")
+    tree.replace(3, leaves[3])
+    assert_equal(tree.root(), CBlock.get_merkle_root(leaves))
+    tree.update(leaves[:2])
+    assert_equal(tree.root(), CBlock.get_merkle_root(leaves[:2]))
+
+    # Folding a leaf with its branch gives back the root
+    tree.update(leaves)
+    node = leaves[6]
+    for sibling in tree.get_branch(6):
+        node = hash256(sibling + node)
+    assert_equal(ser_uint256(tree.root()), node)
+
+    # Only the path to the matched leaf is expanded
+    pmt = tree.get_partial_merkle_tree([False] * 6 + [True])
+    assert_equal(pmt.nTransactions, 7)
+    assert_equal(pmt.vBits, [True, False, True, False, True, True])
+    assert_equal(len(pmt.vHash), 3)
+
+    # A bulk build or update gives the same levels as appending leaf by leaf
+    def check_levels(tree, leaves):
+        assert_equal(tree.root(), CBlock.get_merkle_root(leaves))
+        appended = MerkleTree()
+        for leaf in leaves:
+            appended.append(leaf)
+        assert_equal(tree.levels, appended.levels)
+
+    leaves = [hash256(i.to_bytes(2, "little")) for i in range(100)]
+    for n in [1, 2, 3, 64, 65, 100]:
+        check_levels(MerkleTree(leaves[:n]), leaves[:n])
+    tree = MerkleTree(leaves[:40])
+    for n in [41, 100, 63, 1, 100]:
+        tree.update(leaves[:n])
+        check_levels(tree, leaves[:n])
+    changed = [hash256(leaf) if i % 3 == 0 else leaf for i, leaf in enumerate(leaves)]
+    tree.update(changed)
+    check_levels(tree, changed)
+
+def test_uint256():
+    assert_equal(ser_uint256(1), bytes([1]) + bytes(31))
+    assert_equal(ser_uint256(-1), bytes([0xff] * 32))
+    assert_equal(uint256_from_str(bytes(31) + bytes([0x80])), 1 << 255)
+    hashes = [0, 1, (1 << 256) - 1, 0x1234 << 100]
+    assert_equal(deser_uint256_vector(BytesReader(ser_uint256_vector(hashes))), hashes)
+    msg = msg_getdata([CInv(1, h) for h in hashes])
+    decoded = msg_getdata()
+    decoded.deserialize(BytesReader(msg.serialize()))
+    assert_equal(repr(decoded), repr(msg))
+
+def test_lazy_block():
+    block = CBlock()
+    for i in range(3):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(i, 0)))
+        block.vtx.append(tx)
+    block.hashMerkleRoot = block.calc_merkle_root()
+    block.rehash()
+
+    msg = msg_lazy_block()
+    msg.deserialize(BytesReader(block.serialize()))
+    assert_equal(msg.block.rehash(), block.sha256)
+    # The transactions are only decoded once vtx is used
+    assert msg.block._vtx_data is not None
+    assert_equal(msg.block.calc_merkle_root(), block.hashMerkleRoot)
+    assert msg.block._vtx_data is None
+    assert_equal(msg.block.serialize(), block.serialize())
+    assert_equal(repr(msg.block), repr(block))
+
+def test_tx_batch():
+    legacy = CTransaction()
+    legacy.vin.append(CTxIn(COutPoint(1, 2), b"\x51", 0xfffffffe))
+    legacy.vout.append(CTxOut(1000, b"\x52"))
+    legacy.nLockTime = 100
+    segwit = CTransaction(legacy)
+    segwit.vin.append(CTxIn(COutPoint(3, 4)))
+    segwit.wit.vtxinwit = [CTxInWitness(), CTxInWitness()]
+    segwit.wit.vtxinwit[1].scriptWitness.stack = [b"\x01", b""]
+
+    batch = TxBatch([legacy, segwit])
+    batch.add_transaction(nVersion=2)
+    batch.add_input(5, 6, witness_stack=[b"\x02"])
+    batch.add_output(3000, b"\x53")
+    assert_equal(len(batch), 3)
+    built = batch.get_transaction(2)
+    assert_equal(built.nVersion, 2)
+    assert_equal(built.wit.vtxinwit[0].scriptWitness.stack, [b"\x02"])
+
+    txs = [legacy, segwit, built]
+    assert_equal(batch.to_hex(), [tx.serialize().hex() for tx in txs])
+    assert_equal(batch.to_hex(with_witness=False), [tx.serialize_without_witness().hex() for tx in txs])
+    for tx in txs:
+        tx.rehash()
+    assert_equal(batch.calc_sha256(), [tx.sha256 for tx in txs])
+    assert_equal(batch.calc_sha256(with_witness=True), [tx.calc_sha256(with_witness=True) for tx in txs])
+    assert_equal([tx.serialize() for tx in batch], [tx.serialize() for tx in txs])
+
+def test_clone():
+    tx = CTransaction()
+    tx.vin.append(CTxIn(COutPoint(1, 2), b"\x51"))
+    tx.vout.append(CTxOut(1000, b"\x52"))
+    tx.wit.vtxinwit.append(CTxInWitness())
+    tx.wit.vtxinwit[0].scriptWitness.stack.append(b"\x01")
+    tx.rehash()
+    block = CBlock()
+    block.vtx.append(tx)
+
+    copied = block.clone()
+    assert_equal(copied.serialize(), block.serialize())
+    # Changing the copy leaves the original alone
+    copied.vtx[0].vin[0].prevout.n = 3
+    copied.vtx[0].vout[0].nValue = 2000
+    copied.vtx[0].wit.vtxinwit[0].scriptWitness.stack.append(b"\x02")
+    copied.vtx.append(CTransaction())
+    assert_equal(len(block.vtx), 1)
+    assert_equal(tx.serialize(), CTransaction(tx).serialize())
+    assert_equal(tx.vin[0].prevout.n, 2)
+    assert_equal(tx.vout[0].nValue, 1000)
+    assert_equal(tx.wit.vtxinwit[0].scriptWitness.stack, [b"\x01"])
+    assert tx.rehash() != copied.vtx[0].rehash()
+
+def test_siphash256_batch():
+    k0, k1 = 0x0706050403020100, 0x0F0E0D0C0B0A0908
+    hashes = [0, 1, (1 << 256) - 1, 0x1F1E1D1C1B1A191817161514131211100F0E0D0C0B0A09080706050403020100]
+    expected = [siphash.siphash256(k0, k1, h) for h in hashes]
+    assert_equal(siphash.siphash256_batch(k0, k1, hashes, use_numpy=False), expected)
+    if siphash.numpy is not None:
+        assert_equal(siphash.siphash256_batch(k0, k1, hashes, use_numpy=True), expected)
+
+def test_repr_truncated():
+    block = CBlock()
+    for i in range(100):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(i, 0), b"\x01" * 100))
+        tx.vout.append(CTxOut(i, b"\x51"))
+        tx.wit.vtxinwit.append(CTxInWitness())
+        tx.wit.vtxinwit[0].scriptWitness.stack = [b"\x02" * 10]
+        block.vtx.append(tx)
+    full = repr(msg_block(block))
+    assert "..." not in full
+    for max_len in [0, 1, 100, 500, 5000, len(full), len(full) + 1]:
+        assert_equal(repr_truncated(msg_block(block), max_len), full[:max_len])
+    # Unaffected outside of repr_truncated()
+    assert_equal(repr(msg_block(block)), full)
+
+def test_header_chain():
+    for height in list(range(20)) + [127, 128, 149, 150, 151, 299, 300, 32767, 32768, 10 ** 6]:
+        assert_equal(HeaderChain.coinbase_txid(height), ser_uint256(create_coinbase(height).sha256))
+
+    chain = HeaderChain(0x1234, 140, 1296688602)
+    chain.extend(10)
+    chain.extend(15)
+    assert_equal(len(chain), 25)
+    prev_hash = 0x1234
+    for i in range(25):
+        # Heights 141 to 165 cover the first regtest halving
+        block = create_block(prev_hash, create_coinbase(141 + i), 1296688602 + i + 1, version=4)
+        block.solve()
+        assert_equal(chain.get_hash(i), block.sha256)
+        assert_equal(chain.get_header(i).serialize(), block.serialize()[:80])
+        prev_hash = block.sha256
+
+    pooled = HeaderChain(0x1234, 140, 1296688602)
+    pooled.extend(25, processes=2)
+    assert_equal(pooled.headers, chain.headers)
+
+    messages = list(chain.headers_messages(5, batch_size=8))
+    assert_equal([len(msg.raw_headers) // 80 for msg in messages], [8, 8, 4])
+    decoded = msg_headers()
+    decoded.deserialize(BytesReader(messages[1].serialize()))
+    assert_equal([header.sha256 for header in decoded.headers], [chain.get_hash(i) for i in range(13, 21)])
+
+class FrameworkTestMessages(BitcoinTestFramework):
+    def setup_network(self):
+        pass
+
+    def set_test_params(self):
+        self.num_nodes = 0
+
+    def run_test(self):
+        test_bytes_reader()
+        test_serialize_into()
+        test_tx_cache()
+        test_merkle_tree()
+        test_uint256()
+        test_lazy_block()
+        test_tx_batch()
+        test_clone()
+        test_siphash256_batch()
+        test_repr_truncated()
+        test_header_chain()
+
+if __name__ == '__main__':
+    FrameworkTestMessages().main()
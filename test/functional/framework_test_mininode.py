@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Tests for test_framework.mininode, p2p_capture and wait_until()."""
+
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+
+from test_framework.p2p_capture import MessageCapture, decode_capture, read_capture, replay_capture
+from test_framework.messages import CBlock, msg_getheaders, msg_ping
+from test_framework.mininode import (
+    CAPTURE_RECEIVE,
+    CAPTURE_SEND,
+    FramedMessageCache,
+    MAGIC_BYTES,
+    debug_log_handled,
+    mininode_lock,
+    NetworkThread,
+    P2PConnection,
+    P2PDataStore,
+)
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import assert_equal, assert_raises, wait_until
+
+class ReceivingConnection(P2PConnection):
+    """A connection that isn't opened, for feeding data_received() directly.
+
+    Records the nonces of the pings it receives in received."""
+    def __init__(self):
+        super().__init__()
+        self.dstaddr, self.dstport = "127.0.0.1", 0
+        self.magic_bytes = MAGIC_BYTES["regtest"]
+        self.recvbuf = bytearray()
+        self.recvbuf_pos = 0
+        self.received = []
+
+    def on_message(self, message):
+        self.received.append(message.nonce)
+
+def test_framed_message_cache():
+    conn = P2PConnection()
+    conn.magic_bytes = MAGIC_BYTES["regtest"]
+    uncached = conn.build_message(msg_ping(1))
+    conn.message_cache = FramedMessageCache(max_bytes=2 * (len(uncached) + 8))
+    assert_equal(conn.build_message(msg_ping(1)), uncached)
+    assert conn.build_message(msg_ping(1)) is conn.build_message(msg_ping(1))
+    assert_equal((conn.message_cache.hits, conn.message_cache.misses), (2, 1))
+
+    # The least recently used message is evicted once the cache is full
+    conn.build_message(msg_ping(2))
+    conn.build_message(msg_ping(1))
+    conn.build_message(msg_ping(3))
+    assert_equal(len(conn.message_cache), 2)
+    assert conn.message_cache.size <= conn.message_cache.max_bytes
+    misses = conn.message_cache.misses
+    conn.build_message(msg_ping(1))
+    conn.build_message(msg_ping(2))
+    assert_equal(conn.message_cache.misses, misses + 1)
+
+def test_recv_buffer():
+    conn = ReceivingConnection()
+    stream = b"".join([conn.build_message(msg_ping(i)) for i in range(100)])
+    # Messages split across reads are framed once they're complete
+    for i in range(0, len(stream), 7):
+        conn.data_received(stream[i:i + 7])
+    assert_equal(conn.received, list(range(100)))
+    assert_equal(len(conn.recvbuf), 0)
+    conn.data_received(stream[:10])
+    assert_equal(bytes(conn.recvbuf), stream[:10])
+
+    # A bad frame after a good one in the same read raises its own error
+    payload = b"\x00" * 8
+    checksum = hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
+    bogus = conn.magic_bytes + b"bogus".ljust(12, b"\x00") + struct.pack("<I", len(payload)) + checksum + payload
+    frame = conn.build_message(msg_ping(1))
+    bad_checksum = frame[:20] + b"\x00" * 4 + frame[24:]
+    for bad_frame, message in [(bogus, "Received unknown msgtype"), (bad_checksum, "got bad checksum")]:
+        conn.recvbuf = bytearray()
+        conn.recvbuf_pos = 0
+        conn.received = []
+        try:
+            conn.data_received(stream[:len(stream) // 100] + bad_frame)
+        except ValueError as e:
+            assert message in str(e)
+        else:
+            raise AssertionError("No exception raised")
+        assert_equal(conn.received, [0])
+
+def test_capture(tmpdir):
+    class NoLoop:
+        def call_soon_threadsafe(self, callback):
+            pass
+
+    class ReplayTarget:
+        def send_raw_message(self, raw_message_bytes):
+            sent.append(raw_message_bytes)
+
+    conn = ReceivingConnection()
+    frames = [conn.build_message(msg_ping(i)) for i in range(10)]
+    path = os.path.join(tmpdir, "capture.bin")
+    with MessageCapture(path) as capture:
+        conn.capture = capture
+        conn.data_received(b"".join(frames[:5]))
+        # Frames are recorded when they're queued, before the write is scheduled
+        conn._transport = True
+        conn._loop = NoLoop()
+        for frame in frames[5:]:
+            conn.send_raw_message(frame)
+    assert_equal(capture.frames, 10)
+
+    records = list(read_capture(path))
+    assert_equal([frame for _, _, frame in records], frames)
+    assert_equal([direction for direction, _, _ in records], [CAPTURE_RECEIVE] * 5 + [CAPTURE_SEND] * 5)
+    assert_equal([msg.nonce for _, _, msg in decode_capture(path)], list(range(10)))
+
+    sent = []
+    assert_equal(replay_capture(path, ReplayTarget(), speed=None), 5)
+    assert_equal(sent, frames[5:])
+
+def test_log_message():
+    log = logging.getLogger("TestFramework.framework_test")
+    log.propagate = False
+    handler = logging.NullHandler()
+    handler.setLevel(logging.INFO)
+    log.addHandler(handler)
+    try:
+        log.setLevel(logging.DEBUG)
+        assert not debug_log_handled(log)
+        handler.setLevel(logging.DEBUG)
+        assert debug_log_handled(log)
+        log.setLevel(logging.INFO)
+        assert not debug_log_handled(log)
+    finally:
+        log.removeHandler(handler)
+
+    class Unprintable:
+        def __repr__(self):
+            raise AssertionError("repr() called")
+
+    conn = P2PConnection()
+    conn.dstaddr, conn.dstport = "127.0.0.1", 0
+    # The framework logs debug messages to its log file
+    assert_raises(AssertionError, conn._log_message, "receive", Unprintable())
+    conn.log_messages = False
+    conn._log_message("receive", Unprintable())
+
+def test_network_threads():
+    loops = NetworkThread.network_event_loops
+    assert_equal(len(loops), 2)
+    assert NetworkThread.get_event_loop(3) is loops[1]
+
+    # A connection that was never opened can still be disconnected, and
+    # refuses to send
+    unopened = P2PConnection()
+    unopened.peer_disconnect()
+    assert_raises(IOError, unopened.send_raw_message, b"")
+    assert_raises(IOError, unopened.send_raw_messages, [b""])
+
+    class EchoProtocol(asyncio.Protocol):
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def data_received(self, data):
+            self.transport.write(data)
+
+    class EchoedConnection(P2PConnection):
+        def on_open(self):
+            pass
+
+        def on_close(self):
+            pass
+
+        def on_message(self, message):
+            with mininode_lock:
+                self.received.append(message.nonce)
+
+    # Each connection gets its pings echoed back on its own event loop
+    server = asyncio.run_coroutine_threadsafe(loops[0].create_server(EchoProtocol, "127.0.0.1", 0), loops[0]).result()
+    port = server.sockets[0].getsockname()[1]
+    conns = []
+    for _ in range(4):
+        conn = EchoedConnection()
+        conn.received = []
+        conn.peer_connect("127.0.0.1", port, net="regtest")()
+        conns.append(conn)
+    assert_equal(set(conn._loop for conn in conns), set(loops))
+    wait_until(lambda: all(conn.is_connected for conn in conns), timeout=10)
+    for i, conn in enumerate(conns):
+        conn.send_message(msg_ping(i))
+    wait_until(lambda: [conn.received for conn in conns] == [[i] for i in range(4)], timeout=10, lock=mininode_lock)
+
+    # Batched sends arrive complete and in order
+    conns[0].send_messages((msg_ping(i) for i in range(4, 2004)), batch_size=4096)
+    wait_until(lambda: len(conns[0].received) == 2001, timeout=10, lock=mininode_lock)
+    assert_equal(conns[0].received, [0] + list(range(4, 2004)))
+    # Sends wait while the write buffer is full
+    conns[0].pause_writing()
+    assert_raises(IOError, conns[0].send_raw_messages, [conns[0].build_message(msg_ping(0))], timeout=0.1)
+    conns[0].resume_writing()
+
+    for conn in conns:
+        conn.peer_disconnect()
+    wait_until(lambda: not any(conn.is_connected for conn in conns), timeout=10)
+    loops[0].call_soon_threadsafe(server.close)
+
+def test_wait_until_condition():
+    cond = threading.Condition()
+    state = {"ready": False, "checks": 0}
+
+    def set_ready():
+        with cond:
+            state["ready"] = True
+            cond.notify_all()
+
+    # A notified wakeup re-checks the predicate
+    threading.Timer(0.01, set_ready).start()
+    wait_until(lambda: state["ready"], timeout=10, lock=cond)
+
+    def check():
+        state["checks"] += 1
+        return False
+
+    def notify(n):
+        for _ in range(n):
+            with cond:
+                cond.notify_all()
+            time.sleep(0.001)
+
+    # Notified wakeups count as attempts
+    notifier = threading.Thread(target=notify, args=(1000,))
+    notifier.start()
+    assert_raises(AssertionError, wait_until, check, attempts=5, lock=cond)
+    notifier.join()
+    assert_equal(state["checks"], 5)
+
+    # Without notifications, the predicate is re-checked every 50ms until the timeout
+    state["checks"] = 0
+    start = time.time()
+    assert_raises(AssertionError, wait_until, check, timeout=0.2, lock=cond)
+    assert time.time() - start >= 0.2
+    assert state["checks"] >= 2
+
+def test_block_store():
+    store = P2PDataStore()
+    prev = 0x1234  # parent not in the store
+    hashes = []
+    for _ in range(3):
+        block = CBlock()
+        block.hashPrevBlock = prev
+        block.rehash()
+        store.store_block(block)
+        prev = block.sha256
+        hashes.append(prev)
+    assert_equal(store.last_block_hash, prev)
+    assert_equal(store.active_chain, hashes)
+
+def test_getheaders():
+    def make_chain(prev, length, nonce=0):
+        chain = []
+        for _ in range(length):
+            block = CBlock()
+            block.hashPrevBlock = prev
+            block.nNonce = nonce
+            block.rehash()
+            chain.append(block)
+            prev = block.sha256
+        return chain
+
+    def getheaders(locator, hash_stop=0):
+        sent = []
+        store.send_message = sent.append
+        request = msg_getheaders()
+        request.locator.vHave = locator
+        request.hashstop = hash_stop
+        store.on_getheaders(request)
+        return [header.sha256 for header in sent[0].headers]
+
+    store = P2PDataStore()
+    chain = make_chain(0, 2500)
+    for block in chain:
+        store.store_block(block)
+    hashes = [block.sha256 for block in chain]
+    assert_equal(getheaders([]), hashes[:2000])
+    assert_equal(getheaders([hashes[2100], hashes[10]]), hashes[2101:])
+    assert_equal(getheaders([hashes[-1]]), [])
+    assert_equal(getheaders([0x1234, hashes[10]], hash_stop=hashes[20]), hashes[11:21])
+
+    # Reorg onto a fork of block 2099
+    fork = make_chain(hashes[2099], 3, nonce=1)
+    for block in fork:
+        store.store_block(block)
+    assert_equal(len(store.active_chain), 2103)
+    assert_equal(getheaders([hashes[2200], hashes[2000]]), hashes[2001:2100] + [block.sha256 for block in fork])
+
+class FrameworkTestMininode(BitcoinTestFramework):
+    def setup_network(self):
+        pass
+
+    def set_test_params(self):
+        self.num_nodes = 0
+        self.num_network_threads = 2
+
+    def run_test(self):
+        test_framed_message_cache()
+        test_recv_buffer()
+        test_capture(self.options.tmpdir)
+        test_log_message()
+        test_network_threads()
+        test_wait_until_condition()
+        test_block_store()
+        test_getheaders()
+
+if __name__ == '__main__':
+    FrameworkTestMininode().main()
@@ -9,7 +9,6 @@ import sys
 
 from test_framework import messages
 from test_framework.mininode import (
-    NetworkThread,
     P2PDataStore,
     P2PInterface,
 )
@@ -155,7 +154,7 @@ class InvalidMessagesTest(BitcoinTestFramework):
 
         # Call .result() to block until the atomic swap is complete, otherwise
         # we might run into races later on
-        asyncio.run_coroutine_threadsafe(swap_magic_bytes(), NetworkThread.network_event_loop).result()
+        asyncio.run_coroutine_threadsafe(swap_magic_bytes(), conn._loop).result()
 
         with self.nodes[0].assert_debug_log(['PROCESSMESSAGE: INVALID MESSAGESTART ping']):
             conn.send_message(messages.msg_ping(nonce=0xff))
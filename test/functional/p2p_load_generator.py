@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Test the node's P2P message handling under synthetic inbound load.
+
+- Open a number of connections to the node with LoadGenerator
+- Send the default message mix (inv, getdata, tx, headers and ping) from all of
+  them at the target rate
+- Check that no connection was dropped, that the node answered every ping and
+  received everything that was sent, and that it still responds to RPC
+
+The number of connections, their rate and the duration can be changed to use
+the test as a benchmark, eg:
+
+    test/functional/p2p_load_generator.py --connections=32 --rate=2000 --duration=30
+"""
+
+from test_framework.p2p_load import LoadGenerator
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import assert_equal, assert_greater_than_or_equal
+
+
+class P2PLoadGeneratorTest(BitcoinTestFramework):
+    def set_test_params(self):
+        self.setup_clean_chain = True
+        self.num_nodes = 1
+
+    def add_options(self, parser):
+        parser.add_argument("--connections", type=int, default=8, help="number of connections to open (default: %(default)s)")
+        parser.add_argument("--rate", type=int, default=200, help="messages per second on each connection (default: %(default)s)")
+        parser.add_argument("--duration", type=float, default=5, help="seconds to send for (default: %(default)s)")
+
+    def run_test(self):
+        node = self.nodes[0]
+        load = LoadGenerator(node, connections=self.options.connections, rate=self.options.rate)
+        load.connect()
+        bytes_before = sum(sum(peer["bytesrecv_per_msg"].values()) for peer in node.getpeerinfo())
+
+        self.log.info("Send load for {}s".format(self.options.duration))
+        stats = load.run(self.options.duration)
+        self.log.info(stats)
+
+        self.log.info("Check that the node handled all of it")
+        assert_equal(stats.disconnects, 0)
+        assert_equal(stats.pings_unanswered, 0)
+        assert stats.ping_times
+        assert_equal(len(node.getpeerinfo()), self.options.connections)
+        bytes_after = sum(sum(peer["bytesrecv_per_msg"].values()) for peer in node.getpeerinfo())
+        assert_greater_than_or_equal(bytes_after - bytes_before, stats.bytes_sent)
+        self.log.info("Ping round trip p50 {:.1f}ms, p99 {:.1f}ms".format(1000 * stats.ping_percentile(50), 1000 * stats.ping_percentile(99)))
+
+
+if __name__ == '__main__':
+    P2PLoadGeneratorTest().main()
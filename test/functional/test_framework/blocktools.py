@@ -11,7 +11,9 @@ from .address import (
     script_to_p2wsh,
 )
 from .messages import (
+    BytesReader,
     CBlock,
+    CBlockHeader,
     COIN,
     COutPoint,
     CTransaction,
@@ -22,8 +24,11 @@ from .messages import (
     ToHex,
     hash256,
     hex_str_to_bytes,
+    msg_raw_headers,
+    ser_string,
     ser_uint256,
     sha256,
+    uint256_from_compact,
     uint256_from_str,
 )
 from .script import (
@@ -38,8 +43,10 @@ from .script import (
     OP_TRUE,
     hash160,
 )
-from .util import assert_equal
+from .util import assert_equal, map_chunks
+import hashlib
 from io import BytesIO
+import struct
 
 MAX_BLOCK_SIGOPS = 20000
 
@@ -99,6 +106,10 @@ def script_BIP34_coinbase_height(height):
     return CScript([CScriptNum(height)])
 
 
+def _coinbase_value(height):
+    halvings = int(height / 150)  # regtest
+    return (50 * COIN) >> halvings
+
 def create_coinbase(height, pubkey=None):
     """Create a coinbase transaction, assuming no miner fees.
 
@@ -107,9 +118,7 @@ def create_coinbase(height, pubkey=None):
     coinbase = CTransaction()
     coinbase.vin.append(CTxIn(COutPoint(0, 0xffffffff), script_BIP34_coinbase_height(height), 0xffffffff))
     coinbaseoutput = CTxOut()
-    coinbaseoutput.nValue = 50 * COIN
-    halvings = int(height / 150)  # regtest
-    coinbaseoutput.nValue >>= halvings
+    coinbaseoutput.nValue = _coinbase_value(height)
     if (pubkey is not None):
         coinbaseoutput.scriptPubKey = CScript([pubkey, OP_CHECKSIG])
     else:
@@ -118,6 +127,112 @@ def create_coinbase(height, pubkey=None):
     coinbase.calc_sha256()
     return coinbase
 
+class HeaderChain:
+    """A chain of regtest block headers, built without any CBlock objects.
+
+    Each header commits to the single coinbase transaction create_coinbase()
+    returns for its height, is time_step seconds later than its parent and is
+    ground to the regtest proof of work target. The headers are stored
+    serialized (80 bytes each) in one bytearray and their hashes (32 bytes
+    each) in another, so a chain of a million headers takes about 110MB."""
+
+    def __init__(self, prev_hash, prev_height, prev_time, *, version=4, time_step=1, nbits=0x207fffff):
+        self.start_height = prev_height + 1
+        self.version = version
+        self.time_step = time_step
+        self.nbits = nbits
+        self.target = uint256_from_compact(nbits)
+        self.headers = bytearray()
+        self.hashes = bytearray()
+        self._prev_hash = ser_uint256(prev_hash)
+        self._prev_time = prev_time
+
+    def __len__(self):
+        return len(self.hashes) // 32
+
+    @staticmethod
+    def coinbase_txid(height):
+        """Return the serialized txid of create_coinbase(height)."""
+        return hash256(b"".join([
+            _COINBASE_PREFIX, ser_string(script_BIP34_coinbase_height(height)),
+            _COINBASE_MIDDLE, struct.pack("<q", _coinbase_value(height)), _COINBASE_SUFFIX]))
+
+    def extend(self, count, *, processes=None):
+        """Add count headers to the chain.
+
+        Each header depends on the hash of the previous one, so the headers
+        are ground one after the other (at regtest difficulty, about two
+        hashes each). The coinbase txids don't, and are computed by a pool of
+        processes if processes is set."""
+        headers, hashes = self.headers, self.hashes
+        version = struct.pack("<i", self.version)
+        nbits = struct.pack("<I", self.nbits)
+        target = self.target
+        prev_hash = self._prev_hash
+        prev_time = self._prev_time
+        first_height = self.start_height + len(self)
+        heights = range(first_height, first_height + count)
+        if processes:
+            chunks = map_chunks(_coinbase_txids, heights, processes, chunk_size=10000)
+            merkle_roots = [txid for chunk in chunks for txid in chunk]
+        else:
+            # With a single transaction the merkle root is its txid
+            merkle_roots = map(HeaderChain.coinbase_txid, heights)
+        for merkle_root in merkle_roots:
+            prev_time += self.time_step
+            # Only the nonce changes while grinding, so hash the rest once
+            prefix = hashlib.sha256(b"".join([version, prev_hash, merkle_root, struct.pack("<I", prev_time), nbits]))
+            nonce = 0
+            while True:
+                h = prefix.copy()
+                h.update(struct.pack("<I", nonce))
+                block_hash = hashlib.sha256(h.digest()).digest()
+                if int.from_bytes(block_hash, "little") <= target:
+                    break
+                nonce += 1
+            headers += b"".join([version, prev_hash, merkle_root, struct.pack("<III", prev_time, self.nbits, nonce)])
+            hashes += block_hash
+            prev_hash = block_hash
+        self._prev_hash = prev_hash
+        self._prev_time = prev_time
+
+    def get_hash(self, index):
+        """Return the hash of the header at index (counted from the first header, not by height)."""
+        return uint256_from_str(self.hashes[32 * index:32 * index + 32])
+
+    def get_header(self, index):
+        header = CBlockHeader()
+        header.deserialize(BytesReader(self.headers[80 * index:80 * index + 80]))
+        header.calc_sha256()
+        return header
+
+    def headers_messages(self, start=0, end=None, *, batch_size=2000):
+        """Yield msg_raw_headers for the headers from index start to end, in
+        batches of at most batch_size (2000 is the most a node accepts in
+        one message)."""
+        end = len(self) if end is None else min(end, len(self))
+        for i in range(start, end, batch_size):
+            yield msg_raw_headers(self.headers[80 * i:80 * min(i + batch_size, end)])
+
+
+def _coinbase_txids(heights):
+    return [HeaderChain.coinbase_txid(height) for height in heights]
+
+def _split_coinbase():
+    """Split the serialization of create_coinbase() around the two fields
+    that depend on the height: the scriptSig and the output value."""
+    coinbase = create_coinbase(1)
+    script_sig = CScript(b"\xa5" * 40)
+    value = 0x0123456789abcdef
+    coinbase.vin[0].scriptSig = script_sig
+    coinbase.vout[0].nValue = value
+    prefix, rest = coinbase.serialize_without_witness().split(ser_string(script_sig))
+    middle, suffix = rest.split(struct.pack("<q", value))
+    return prefix, middle, suffix
+
+_COINBASE_PREFIX, _COINBASE_MIDDLE, _COINBASE_SUFFIX = _split_coinbase()
+
+
 def create_tx_with_script(prevtx, n, script_sig=b"", *, amount, script_pub_key=CScript()):
     """Return one-input, one-output transaction object
        spending the prevtx's n-th output with the given amount.
@@ -6,9 +6,14 @@
 WARNING: This code is slow, uses bad randomness, does not properly protect
 keys, and is trivially vulnerable to side channel attacks. Do not use for
 anything but tests."""
+import functools
+import hashlib
+import hmac
+import os
 import random
 
 from .address import byte_to_base58
+from .util import map_chunks
 
 def modinv(a, n):
     """Compute the modular inverse of a modulo n
@@ -27,6 +32,28 @@ def modinv(a, n):
         t1 += n
     return t1
 
+def modinv_all(values, n):
+    """Compute the modular inverses of all values modulo n with a single modinv (Montgomery's trick)
+
+    See https://en.wikipedia.org/wiki/Modular_multiplicative_inverse#Multiple_inverses.
+    None of the values may be 0 modulo n.
+    """
+    # Running products of the values
+    products = []
+    acc = 1
+    for a in values:
+        acc = (acc * a) % n
+        products.append(acc)
+    inv = modinv(acc, n)
+    result = [None] * len(products)
+    for i in range(len(products) - 1, 0, -1):
+        # inv is the inverse of products[i]
+        result[i] = (inv * products[i - 1]) % n
+        inv = (inv * values[i]) % n
+    if products:
+        result[0] = inv
+    return result
+
 def jacobi_symbol(n, k):
     """Compute the Jacobi symbol of n modulo k
 
@@ -66,12 +93,36 @@ def modsqrt(a, p):
         return sqrt
     return None
 
+def wnaf(n, w):
+    """Compute the width-w non-adjacent form of a non-negative integer n.
+
+    Returns the digits, least significant first. Every digit is either 0 or
+    odd and less than 2**(w-1) in absolute value, and any w consecutive digits
+    contain at most one non-zero digit."""
+    digits = []
+    while n:
+        if n & 1:
+            d = n & ((1 << w) - 1)
+            if d >= 1 << (w - 1):
+                d -= 1 << w
+            n -= d
+        else:
+            d = 0
+        digits.append(d)
+        n >>= 1
+    return digits
+
 class EllipticCurve:
+    # Window width of the wNAF multiplication of points without a fixed base table
+    WNAF_WIDTH = 5
+
     def __init__(self, p, a, b):
         """Initialize elliptic curve y^2 = x^3 + a*x + b over GF(p)."""
         self.p = p
         self.a = a % p
         self.b = b % p
+        # Fixed base tables, by point. See add_fixed_base()
+        self.fixed_bases = {}
 
     def affine(self, p1):
         """Convert a Jacobian point tuple p1 to affine form, or None if at infinity.
@@ -80,11 +131,31 @@ class EllipticCurve:
         x1, y1, z1 = p1
         if z1 == 0:
             return None
+        if z1 == 1:
+            return (x1 % self.p, y1 % self.p, 1)
         inv = modinv(z1, self.p)
         inv_2 = (inv**2) % self.p
         inv_3 = (inv_2 * inv) % self.p
         return ((inv_2 * x1) % self.p, (inv_3 * y1) % self.p, 1)
 
+    def batch_affine(self, points):
+        """Convert a list of Jacobian tuples to affine form, or None for those at infinity.
+
+        The z coordinates are inverted together with modinv_all()."""
+        zs = [z for (_, _, z) in points if z != 0]
+        if not zs:
+            return [None] * len(points)
+        z_invs = iter(modinv_all(zs, self.p))
+        result = []
+        for (x, y, z) in points:
+            if z == 0:
+                result.append(None)
+                continue
+            z_inv = next(z_invs)
+            z_inv_2 = (z_inv**2) % self.p
+            result.append(((x * z_inv_2) % self.p, (y * z_inv_2 * z_inv) % self.p, 1))
+        return result
+
     def negate(self, p1):
         """Negate a Jacobian point tuple p1."""
         x1, y1, z1 = p1
@@ -201,23 +272,114 @@ class EllipticCurve:
         z3 = (h*z1*z2) % self.p
         return (x3, y3, z3)
 
+    def add_fixed_base(self, p1):
+        """Multiply the affine tuple p1 using a fixed base table from now on.
+
+        The table holds j * 256**i * p1 for every byte value j and each of the
+        32 byte positions i of a scalar, as affine points, so that a
+        multiplication takes at most 32 mixed additions and no doublings. It
+        is built the first time it is needed, which takes about 8000 point
+        additions."""
+        assert p1[2] == 1
+        self.fixed_bases.setdefault(p1, None)
+
+    def _fixed_base_table(self, p1):
+        table = self.fixed_bases[p1]
+        if table is None:
+            points = []
+            base = p1
+            for _ in range(32):
+                acc = base
+                for _ in range(255):
+                    points.append(acc)
+                    acc = self.add(acc, base)
+                # acc is now 256 * base
+                base = acc
+            points = self.batch_affine(points)
+            table = self.fixed_bases[p1] = [points[i:i + 255] for i in range(0, len(points), 255)]
+        return table
+
     def mul(self, ps):
         """Compute a (multi) point multiplication
 
-        ps is a list of (Jacobian tuple, scalar) pairs.
+        ps is a list of (Jacobian tuple, scalar) pairs. Points with a fixed
+        base table (see add_fixed_base()) are multiplied with it. The others
+        are multiplied together with Strauss' method: the scalars are written
+        in wNAF, and all points share the doublings.
         """
         r = (0, 1, 0)
-        for i in range(255, -1, -1):
-            r = self.double(r)
-            for (p, n) in ps:
-                if ((n >> i) & 1):
-                    r = self.add(r, p)
-        return r
+        variable = []
+        for (p, n) in ps:
+            if p in self.fixed_bases:
+                table = self._fixed_base_table(p)
+                for i in range(min(32, (n.bit_length() + 7) // 8)):
+                    byte = (n >> (8 * i)) & 0xff
+                    if byte:
+                        r = self.add(r, table[i][byte - 1])
+            else:
+                variable.append((p, n & ((1 << 256) - 1)))
+        if not variable:
+            return r
+
+        # Odd multiples p, 3p, 5p, ... of each point, and their negations
+        tables = []
+        for (p, n) in variable:
+            odd = [p]
+            p_2 = self.double(p)
+            for _ in range((1 << (self.WNAF_WIDTH - 2)) - 1):
+                odd.append(self.add(odd[-1], p_2))
+            tables.append((wnaf(n, self.WNAF_WIDTH), odd, [self.negate(q) for q in odd]))
+        acc = (0, 1, 0)
+        for i in range(max(len(digits) for (digits, _, _) in tables) - 1, -1, -1):
+            acc = self.double(acc)
+            for (digits, odd, odd_neg) in tables:
+                if i < len(digits):
+                    d = digits[i]
+                    if d > 0:
+                        acc = self.add(acc, odd[d >> 1])
+                    elif d < 0:
+                        acc = self.add(acc, odd_neg[-d >> 1])
+        return self.add(r, acc)
 
 SECP256K1 = EllipticCurve(2**256 - 2**32 - 977, 0, 7)
 SECP256K1_G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798, 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8, 1)
 SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
 SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
+SECP256K1.add_fixed_base(SECP256K1_G)
+
+def parse_der_signature(sig):
+    """Extract (r, s) from a strictly DER-encoded ECDSA signature, or return None for any DER encoding errors."""
+    if (sig[1] + 2 != len(sig)):
+        return None
+    if (len(sig) < 4):
+        return None
+    if (sig[0] != 0x30):
+        return None
+    if (sig[2] != 0x02):
+        return None
+    rlen = sig[3]
+    if (len(sig) < 6 + rlen):
+        return None
+    if rlen < 1 or rlen > 33:
+        return None
+    if sig[4] >= 0x80:
+        return None
+    if (rlen > 1 and (sig[4] == 0) and not (sig[5] & 0x80)):
+        return None
+    r = int.from_bytes(sig[4:4+rlen], 'big')
+    if (sig[4+rlen] != 0x02):
+        return None
+    slen = sig[5+rlen]
+    if slen < 1 or slen > 33:
+        return None
+    if (len(sig) != 6 + rlen + slen):
+        return None
+    if sig[6+rlen] >= 0x80:
+        return None
+    if (slen > 1 and (sig[6+rlen] == 0) and not (sig[7+rlen] & 0x80)):
+        return None
+    s = int.from_bytes(sig[6+rlen:6+rlen+slen], 'big')
+    return (r, s)
 
 class ECPubKey():
     """A secp256k1 public key"""
@@ -277,36 +439,10 @@ class ECPubKey():
 
         # Extract r and s from the DER formatted signature. Return false for
         # any DER encoding errors.
-        if (sig[1] + 2 != len(sig)):
-            return False
-        if (len(sig) < 4):
-            return False
-        if (sig[0] != 0x30):
+        rs = parse_der_signature(sig)
+        if rs is None:
             return False
-        if (sig[2] != 0x02):
-            return False
-        rlen = sig[3]
-        if (len(sig) < 6 + rlen):
-            return False
-        if rlen < 1 or rlen > 33:
-            return False
-        if sig[4] >= 0x80:
-            return False
-        if (rlen > 1 and (sig[4] == 0) and not (sig[5] & 0x80)):
-            return False
-        r = int.from_bytes(sig[4:4+rlen], 'big')
-        if (sig[4+rlen] != 0x02):
-            return False
-        slen = sig[5+rlen]
-        if slen < 1 or slen > 33:
-            return False
-        if (len(sig) != 6 + rlen + slen):
-            return False
-        if sig[6+rlen] >= 0x80:
-            return False
-        if (slen > 1 and (sig[6+rlen] == 0) and not (sig[7+rlen] & 0x80)):
-            return False
-        s = int.from_bytes(sig[6+rlen:6+rlen+slen], 'big')
+        r, s = rs
 
         # Verify that r and s are within the group order
         if r < 1 or s < 1 or r >= SECP256K1_ORDER or s >= SECP256K1_ORDER:
@@ -324,11 +460,79 @@ class ECPubKey():
             return False
         return True
 
+def rfc6979_nonce(secret, msg):
+    """Derive the deterministic ECDSA nonce for a 32-byte secret and 32-byte msg.
+
+    See https://tools.ietf.org/html/rfc6979#section-3.2, with HMAC-SHA256 as
+    the HMAC_DRBG and secp256k1's order as q. No extra entropy is added."""
+    def hmac_sha256(key, data):
+        return hmac.new(key, data, hashlib.sha256).digest()
+
+    # bits2octets(msg): reduce the message modulo the group order
+    msg = (int.from_bytes(msg, 'big') % SECP256K1_ORDER).to_bytes(32, 'big')
+    v = b'\x01' * 32
+    k = b'\x00' * 32
+    k = hmac_sha256(k, v + b'\x00' + secret + msg)
+    v = hmac_sha256(k, v)
+    k = hmac_sha256(k, v + b'\x01' + secret + msg)
+    v = hmac_sha256(k, v)
+    while True:
+        v = hmac_sha256(k, v)
+        nonce = int.from_bytes(v, 'big')
+        if 1 <= nonce < SECP256K1_ORDER:
+            return nonce
+        k = hmac_sha256(k, v + b'\x00')
+        v = hmac_sha256(k, v)
+
+class SignatureCache:
+    """A cache of deterministic (RFC6979) ECDSA signatures, keyed by public key, message and low_s.
+
+    If path is given, the cache is loaded from that file if it exists, and
+    save() writes it back, so that later test runs can skip signing the same
+    messages again."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._sigs = {}
+        if path is not None and os.path.exists(path):
+            with open(path, encoding='utf8') as f:
+                for line in f:
+                    pubkey, msg, low_s, sig = line.split()
+                    self._sigs[(bytes.fromhex(pubkey), bytes.fromhex(msg), low_s == '1')] = bytes.fromhex(sig)
+
+    def __len__(self):
+        return len(self._sigs)
+
+    def get(self, pubkey, msg, low_s):
+        sig = self._sigs.get((pubkey, msg, low_s))
+        if sig is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return sig
+
+    def put(self, pubkey, msg, low_s, sig):
+        self._sigs[(pubkey, msg, low_s)] = sig
+
+    def save(self):
+        assert self.path is not None
+        with open(self.path, 'w', encoding='utf8') as f:
+            for (pubkey, msg, low_s), sig in self._sigs.items():
+                f.write('%s %s %d %s\n' % (pubkey.hex(), msg.hex(), low_s, sig.hex()))
+
 class ECKey():
     """A secp256k1 private key"""
 
+    # Set to a SignatureCache to reuse deterministic signatures (see
+    # sign_ecdsa()). Set on the class to share one cache between all keys.
+    signature_cache = None
+
     def __init__(self):
         self.valid = False
+        # The serialized public key, once computed for the signature cache
+        self._pubkey_bytes = None
 
     def set(self, secret, compressed):
         """Construct a private key object with given 32-byte secret and compressed flag."""
@@ -338,6 +542,7 @@ class ECKey():
         if self.valid:
             self.secret = secret
             self.compressed = compressed
+            self._pubkey_bytes = None
 
     def generate(self, compressed=True):
         """Generate a random private key (compressed or uncompressed)."""
@@ -366,26 +571,147 @@ class ECKey():
         ret.compressed = self.compressed
         return ret
 
-    def sign_ecdsa(self, msg, low_s=True):
+    def sign_ecdsa(self, msg, low_s=True, rfc6979=False):
         """Construct a DER-encoded ECDSA signature with this key.
 
         See https://en.wikipedia.org/wiki/Elliptic_Curve_Digital_Signature_Algorithm for the
-        ECDSA signer algorithm."""
+        ECDSA signer algorithm.
+
+        By default the nonce is random (some tests rely on distinct
+        transactions for the same operation). With rfc6979=True it is derived
+        from the key and msg, so the same key always produces the same
+        signature for a msg, and the signature is looked up in and added to
+        signature_cache, if set."""
         assert(self.valid)
+        cache = self.signature_cache if rfc6979 else None
+        if cache is not None:
+            if self._pubkey_bytes is None:
+                self._pubkey_bytes = self.get_pubkey().get_bytes()
+            sig = cache.get(self._pubkey_bytes, msg, low_s)
+            if sig is not None:
+                return sig
         z = int.from_bytes(msg, 'big')
-        # Note: no RFC6979, but a simple random nonce (some tests rely on distinct transactions for the same operation)
-        k = random.randrange(1, SECP256K1_ORDER)
+        if rfc6979:
+            k = rfc6979_nonce(self.get_bytes(), msg)
+        else:
+            k = random.randrange(1, SECP256K1_ORDER)
         R = SECP256K1.affine(SECP256K1.mul([(SECP256K1_G, k)]))
         r = R[0] % SECP256K1_ORDER
         s = (modinv(k, SECP256K1_ORDER) * (z + self.secret * r)) % SECP256K1_ORDER
         if low_s and s > SECP256K1_ORDER_HALF:
             s = SECP256K1_ORDER - s
-        # Represent in DER format. The byte representations of r and s have
-        # length rounded up (255 bits becomes 32 bytes and 256 bits becomes 33
-        # bytes).
-        rb = r.to_bytes((r.bit_length() + 8) // 8, 'big')
-        sb = s.to_bytes((s.bit_length() + 8) // 8, 'big')
-        return b'\x30' + bytes([4 + len(rb) + len(sb), 2, len(rb)]) + rb + bytes([2, len(sb)]) + sb
+        sig = encode_der_signature(r, s)
+        if cache is not None:
+            cache.put(self._pubkey_bytes, msg, low_s, sig)
+        return sig
+
+def get_pubkeys(keys):
+    """Compute ECPubKey objects for a list of ECKeys.
+
+    Like calling get_pubkey() on each of them, but the public keys are
+    converted to affine form together, with a single modinv, instead of one
+    modinv each when they're serialized."""
+    assert(all(key.valid for key in keys))
+    points = SECP256K1.batch_affine([SECP256K1.mul([(SECP256K1_G, key.secret)]) for key in keys])
+    pubkeys = []
+    for key, p in zip(keys, points):
+        pubkey = ECPubKey()
+        pubkey.p = p
+        pubkey.valid = True
+        pubkey.compressed = key.compressed
+        pubkeys.append(pubkey)
+    return pubkeys
+
+def derive_keys(seed, start, end, compressed=True):
+    """Derive the ECKeys with indices start to end (exclusive) from a 32-byte seed.
+
+    Key i only depends on seed and i, so a range of keys can be derived in
+    any number of pieces and always comes out the same."""
+    keys = []
+    for i in range(start, end):
+        secret = int.from_bytes(hashlib.sha256(seed + i.to_bytes(8, 'big')).digest(), 'big') % (SECP256K1_ORDER - 1) + 1
+        key = ECKey()
+        key.set(secret.to_bytes(32, 'big'), compressed)
+        keys.append(key)
+    return keys
+
+def encode_der_signature(r, s):
+    """Represent an ECDSA signature (r, s) in DER format."""
+    # The byte representations of r and s have length rounded up (255 bits
+    # becomes 32 bytes and 256 bits becomes 33 bytes).
+    rb = r.to_bytes((r.bit_length() + 8) // 8, 'big')
+    sb = s.to_bytes((s.bit_length() + 8) // 8, 'big')
+    return b'\x30' + bytes([4 + len(rb) + len(sb), 2, len(rb)]) + rb + bytes([2, len(sb)]) + sb
+
+def _sign_ecdsa_nonces(keys_msgs_nonces, low_s=True):
+    # The affine conversions of all R points and the inversions of all nonces
+    # each take a single modinv
+    Rs = SECP256K1.batch_affine([SECP256K1.mul([(SECP256K1_G, k)]) for (_, _, k) in keys_msgs_nonces])
+    k_invs = modinv_all([k for (_, _, k) in keys_msgs_nonces], SECP256K1_ORDER)
+    sigs = []
+    for (key, msg, _), R, k_inv in zip(keys_msgs_nonces, Rs, k_invs):
+        assert(key.valid)
+        z = int.from_bytes(msg, 'big')
+        r = R[0] % SECP256K1_ORDER
+        s = (k_inv * (z + key.secret * r)) % SECP256K1_ORDER
+        if low_s and s > SECP256K1_ORDER_HALF:
+            s = SECP256K1_ORDER - s
+        sigs.append(encode_der_signature(r, s))
+    return sigs
+
+def sign_ecdsa_batch(keys_and_msgs, low_s=True, processes=None, rfc6979=False):
+    """Sign a list of (ECKey, msg) pairs, like ECKey.sign_ecdsa does for each of them.
+
+    Returns the list of DER-encoded signatures. If processes is set, the
+    signing is split over a pool of that many processes (the nonces are
+    still chosen in this process). The signature cache isn't used."""
+    if rfc6979:
+        keys_msgs_nonces = [(key, msg, rfc6979_nonce(key.get_bytes(), msg)) for (key, msg) in keys_and_msgs]
+    else:
+        keys_msgs_nonces = [(key, msg, random.randrange(1, SECP256K1_ORDER)) for (key, msg) in keys_and_msgs]
+    if not keys_msgs_nonces:
+        return []
+    if processes:
+        chunks = map_chunks(functools.partial(_sign_ecdsa_nonces, low_s=low_s), keys_msgs_nonces, processes)
+        return [sig for chunk in chunks for sig in chunk]
+    return _sign_ecdsa_nonces(keys_msgs_nonces, low_s)
+
+def _verify_ecdsa_all(pubkeys_sigs_msgs, low_s=True):
+    results = [False] * len(pubkeys_sigs_msgs)
+    checks = []
+    for i, (pubkey, sig, msg) in enumerate(pubkeys_sigs_msgs):
+        assert(pubkey.valid)
+        rs = parse_der_signature(sig)
+        if rs is None:
+            continue
+        r, s = rs
+        if r < 1 or s < 1 or r >= SECP256K1_ORDER or s >= SECP256K1_ORDER:
+            continue
+        if low_s and s >= SECP256K1_ORDER_HALF:
+            continue
+        checks.append((i, pubkey.p, r, s, int.from_bytes(msg, 'big')))
+    if not checks:
+        return results
+    ws = modinv_all([s for (_, _, _, s, _) in checks], SECP256K1_ORDER)
+    for (i, p, r, _, z), w in zip(checks, ws):
+        u1 = z*w % SECP256K1_ORDER
+        u2 = r*w % SECP256K1_ORDER
+        x, _, z_R = SECP256K1.mul([(SECP256K1_G, u1), (p, u2)])
+        # Compare R's affine x coordinate to r without converting it:
+        # x / z_R**2 == r
+        results[i] = z_R != 0 and (r * z_R * z_R - x) % SECP256K1.p == 0
+    return results
+
+def verify_ecdsa_batch(pubkeys_sigs_msgs, low_s=True, processes=None):
+    """Verify a list of (ECPubKey, sig, msg) triples, like ECPubKey.verify_ecdsa does for each of them.
+
+    Returns a list of booleans. If processes is set, the verification is
+    split over a pool of that many processes."""
+    pubkeys_sigs_msgs = list(pubkeys_sigs_msgs)
+    if processes and pubkeys_sigs_msgs:
+        chunks = map_chunks(functools.partial(_verify_ecdsa_all, low_s=low_s), pubkeys_sigs_msgs, processes)
+        return [result for chunk in chunks for result in chunk]
+    return _verify_ecdsa_all(pubkeys_sigs_msgs, low_s)
 
 def bytes_to_wif(b, compressed=True):
     if compressed:
@@ -18,16 +18,17 @@ ser_*, deser_*: functions that handle serialization/deserialization.
 Classes use __slots__ to ensure extraneous attributes aren't accidentally added
 by tests, compromising their intended effect.
 """
+from array import array
 from codecs import encode
-import copy
 import hashlib
 from io import BytesIO
 import random
 import socket
 import struct
+import threading
 import time
 
-from test_framework.siphash import siphash256
+from test_framework.siphash import siphash256, siphash256_batch
 from test_framework.util import hex_str_to_bytes, assert_equal
 
 MIN_VERSION_SUPPORTED = 60001
@@ -59,11 +60,115 @@ MSG_TYPE_MASK = 0xffffffff >> 2
 
 # Serialization/deserialization tools
 def sha256(s):
-    return hashlib.new('sha256', s).digest()
+    return hashlib.sha256(s).digest()
 
 def hash256(s):
     return sha256(sha256(s))
 
+class _StructCache(dict):
+    """Compiled struct formats, shared by the readers below."""
+    def __missing__(self, fmt):
+        s = self[fmt] = struct.Struct(fmt)
+        return s
+
+_structs = _StructCache()
+
+class BytesReader:
+    """Zero-copy reader over a bytes-like object.
+
+    Walks a single memoryview with an offset cursor. Fixed-size fields are
+    decoded in place with struct.unpack_from, so deserializing an object only
+    allocates the objects it returns. Has the read() method of a binary stream,
+    so it can be passed to any deserialize() method in place of a BytesIO."""
+    __slots__ = ("buf", "pos")
+
+    def __init__(self, data, pos=0):
+        self.buf = data if isinstance(data, memoryview) else memoryview(data)
+        self.pos = pos
+
+    def read(self, n=-1):
+        start = self.pos
+        end = len(self.buf) if n < 0 else min(start + n, len(self.buf))
+        self.pos = end
+        return self.buf[start:end].tobytes()
+
+    def unpack(self, fmt):
+        s = _structs[fmt]
+        r = s.unpack_from(self.buf, self.pos)
+        self.pos += s.size
+        return r
+
+    def read_compact_size(self):
+        pos = self.pos
+        nit = self.buf[pos]
+        if nit < 253:
+            self.pos = pos + 1
+            return nit
+        s = _compact_size_structs[nit]
+        nit = s.unpack_from(self.buf, pos + 1)[0]
+        self.pos = pos + 1 + s.size
+        return nit
+
+    def read_string(self):
+        nit = self.read_compact_size()
+        start = self.pos
+        end = start + nit
+        if end > len(self.buf):
+            end = len(self.buf)
+        self.pos = end
+        return self.buf[start:end].tobytes()
+
+    def read_uint256(self):
+        pos = self.pos
+        if pos + 32 > len(self.buf):
+            raise struct.error("unpack_from requires a buffer of at least %d bytes" % (pos + 32))
+        self.pos = pos + 32
+        return int.from_bytes(self.buf[pos:pos + 32], 'little')
+
+    def tell(self):
+        return self.pos
+
+class StreamReader:
+    """Gives a binary stream (eg a BytesIO) the interface of a BytesReader."""
+    __slots__ = ("f",)
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, n=-1):
+        return self.f.read(n)
+
+    def unpack(self, fmt):
+        s = _structs[fmt]
+        return s.unpack(self.f.read(s.size))
+
+    def read_compact_size(self):
+        nit = struct.unpack("<B", self.f.read(1))[0]
+        if nit >= 253:
+            s = _compact_size_structs[nit]
+            nit = s.unpack(self.f.read(s.size))[0]
+        return nit
+
+    def read_string(self):
+        return self.f.read(self.read_compact_size())
+
+    def read_uint256(self):
+        b = self.f.read(32)
+        if len(b) != 32:
+            raise struct.error("unpack requires a buffer of 32 bytes")
+        return int.from_bytes(b, 'little')
+
+    def tell(self):
+        return self.f.tell()
+
+_compact_size_structs = {253: struct.Struct("<H"), 254: struct.Struct("<I"), 255: struct.Struct("<Q")}
+
+def as_reader(f):
+    """Return f unchanged if it is a reader, otherwise wrap the stream f."""
+    if isinstance(f, (BytesReader, StreamReader)):
+        return f
+    return StreamReader(f)
+
 def ser_compact_size(l):
     r = b""
     if l < 253:
@@ -77,44 +182,43 @@ def ser_compact_size(l):
     return r
 
 def deser_compact_size(f):
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
-    return nit
+    return as_reader(f).read_compact_size()
 
 def deser_string(f):
-    nit = deser_compact_size(f)
-    return f.read(nit)
+    return as_reader(f).read_string()
+
+def ser_compact_size_into(buf, l):
+    if l < 253:
+        buf.append(l)
+    elif l < 0x10000:
+        buf += struct.pack("<BH", 253, l)
+    elif l < 0x100000000:
+        buf += struct.pack("<BI", 254, l)
+    else:
+        buf += struct.pack("<BQ", 255, l)
+    return buf
 
 def ser_string(s):
     return ser_compact_size(len(s)) + s
 
+def ser_string_into(buf, s):
+    ser_compact_size_into(buf, len(s))
+    buf += s
+    return buf
+
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    return as_reader(f).read_uint256()
+
+
+_UINT256_MASK = (1 << 256) - 1
 
 
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & _UINT256_MASK).to_bytes(32, 'little')
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    return int.from_bytes(s[:32], 'little')
 
 
 def uint256_from_compact(c):
@@ -124,7 +228,8 @@ def uint256_from_compact(c):
 
 
 def deser_vector(f, c):
-    nit = deser_compact_size(f)
+    f = as_reader(f)
+    nit = f.read_compact_size()
     r = []
     for i in range(nit):
         t = c()
@@ -137,57 +242,125 @@ def deser_vector(f, c):
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
+    return bytes(ser_vector_into(bytearray(), l, ser_function_name))
+
+
+# Append the serialization of vector l to the bytearray buf. Entries are
+# written with their serialize_into() method, unless an alternate
+# serialization function is named, in which case its result is appended.
+def ser_vector_into(buf, l, ser_function_name=None):
+    ser_compact_size_into(buf, len(l))
     for i in l:
         if ser_function_name:
-            r += getattr(i, ser_function_name)()
+            buf += getattr(i, ser_function_name)()
         else:
-            r += i.serialize()
-    return r
+            i.serialize_into(buf)
+    return buf
 
 
 def deser_uint256_vector(f):
-    nit = deser_compact_size(f)
-    r = []
-    for i in range(nit):
-        t = deser_uint256(f)
-        r.append(t)
-    return r
+    f = as_reader(f)
+    nit = f.read_compact_size()
+    # Read all the hashes in one slice and split it up afterwards
+    data = f.read(nit * 32)
+    if len(data) != nit * 32:
+        raise struct.error("unpack requires a buffer of %d bytes" % (nit * 32))
+    return [int.from_bytes(data[i:i + 32], 'little') for i in range(0, len(data), 32)]
 
 
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
-    for i in l:
-        r += ser_uint256(i)
-    return r
+    return bytes(ser_uint256_vector_into(bytearray(), l))
+
+
+def ser_uint256_vector_into(buf, l):
+    ser_compact_size_into(buf, len(l))
+    buf += b"".join([(i & _UINT256_MASK).to_bytes(32, 'little') for i in l])
+    return buf
+
+
+def deser_inv_vector(f):
+    f = as_reader(f)
+    nit = f.read_compact_size()
+    # Same as deser_vector(f, CInv), but decoded from a single slice
+    data = f.read(nit * 36)
+    if len(data) != nit * 36:
+        raise struct.error("unpack requires a buffer of %d bytes" % (nit * 36))
+    return [CInv(t, int.from_bytes(h, 'little')) for t, h in _structs["<i32s"].iter_unpack(data)]
 
 
 def deser_string_vector(f):
-    nit = deser_compact_size(f)
+    f = as_reader(f)
+    nit = f.read_compact_size()
     r = []
     for i in range(nit):
-        t = deser_string(f)
+        t = f.read_string()
         r.append(t)
     return r
 
 
 def ser_string_vector(l):
-    r = ser_compact_size(len(l))
+    return bytes(ser_string_vector_into(bytearray(), l))
+
+
+def ser_string_vector_into(buf, l):
+    ser_compact_size_into(buf, len(l))
     for sv in l:
-        r += ser_string(sv)
-    return r
+        ser_string_into(buf, sv)
+    return buf
 
 
 # Deserialize from a hex string representation (eg from RPC)
 def FromHex(obj, hex_string):
-    obj.deserialize(BytesIO(hex_str_to_bytes(hex_string)))
+    obj.deserialize(BytesReader(hex_str_to_bytes(hex_string)))
     return obj
 
 # Convert a binary-serializable object to hex (eg for submission via RPC)
 def ToHex(obj):
     return obj.serialize().hex()
 
-# Objects that map to bitcoind objects, which can be serialized/deserialized
+# The number of characters repr_truncated() still has to produce on this
+# thread, or None if it isn't running
+_repr_budget = threading.local()
+
+# Return repr(obj) cut to max_len characters. The reprs of the vectors in obj
+# stop formatting their entries once max_len characters have been produced,
+# so this is cheap even for a large block.
+def repr_truncated(obj, max_len):
+    previous = getattr(_repr_budget, "remaining", None)
+    _repr_budget.remaining = max_len
+    try:
+        return repr(obj)[:max_len]
+    finally:
+        _repr_budget.remaining = previous
+
+# Join the reprs (or item_repr) of the entries of l with sep. Inside
+# repr_truncated() the entries past its budget are replaced with "...".
+def repr_join(l, sep=", ", item_repr=repr):
+    remaining = getattr(_repr_budget, "remaining", None)
+    if remaining is None:
+        return sep.join([item_repr(x) for x in l])
+    r = []
+    for x in l:
+        if remaining <= 0:
+            r.append("...")
+            break
+        s = item_repr(x)
+        # Nested vectors count against the budget while s is built, only
+        # the length of s matters after that
+        remaining -= len(s) + len(sep)
+        _repr_budget.remaining = remaining
+        r.append(s)
+    return sep.join(r)
+
+# repr() of a vector, which is truncated inside repr_truncated()
+def repr_vector(l):
+    return "[" + repr_join(l) + "]"
+
+# Objects that map to bitcoind objects, which can be serialized/deserialized.
+#
+# serialize() returns the object's serialization as bytes. It is built by
+# serialize_into(buf), which appends the serialization to the bytearray buf
+# and returns buf, so that nested objects are written into a single buffer.
 
 
 class CAddress:
@@ -201,22 +374,25 @@ class CAddress:
         self.port = 0
 
     def deserialize(self, f, with_time=True):
+        f = as_reader(f)
         if with_time:
-            self.time = struct.unpack("<i", f.read(4))[0]
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
+            self.time = f.unpack("<i")[0]
+        self.nServices = f.unpack("<Q")[0]
         self.pchReserved = f.read(12)
         self.ip = socket.inet_ntoa(f.read(4))
-        self.port = struct.unpack(">H", f.read(2))[0]
+        self.port = f.unpack(">H")[0]
 
     def serialize(self, with_time=True):
-        r = b""
+        return bytes(self.serialize_into(bytearray(), with_time))
+
+    def serialize_into(self, buf, with_time=True):
         if with_time:
-            r += struct.pack("<i", self.time)
-        r += struct.pack("<Q", self.nServices)
-        r += self.pchReserved
-        r += socket.inet_aton(self.ip)
-        r += struct.pack(">H", self.port)
-        return r
+            buf += struct.pack("<i", self.time)
+        buf += struct.pack("<Q", self.nServices)
+        buf += self.pchReserved
+        buf += socket.inet_aton(self.ip)
+        buf += struct.pack(">H", self.port)
+        return buf
 
     def __repr__(self):
         return "CAddress(nServices=%i ip=%s port=%i)" % (self.nServices,
@@ -241,14 +417,17 @@ class CInv:
         self.hash = h
 
     def deserialize(self, f):
-        self.type = struct.unpack("<i", f.read(4))[0]
-        self.hash = deser_uint256(f)
+        f = as_reader(f)
+        self.type = f.unpack("<i")[0]
+        self.hash = f.read_uint256()
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.type)
-        r += ser_uint256(self.hash)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<i", self.type)
+        buf += ser_uint256(self.hash)
+        return buf
 
     def __repr__(self):
         return "CInv(type=%s hash=%064x)" \
@@ -263,18 +442,21 @@ class CBlockLocator:
         self.vHave = []
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        f = as_reader(f)
+        self.nVersion = f.unpack("<i")[0]
         self.vHave = deser_uint256_vector(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256_vector(self.vHave)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<i", self.nVersion)
+        ser_uint256_vector_into(buf, self.vHave)
+        return buf
 
     def __repr__(self):
         return "CBlockLocator(nVersion=%i vHave=%s)" \
-            % (self.nVersion, repr(self.vHave))
+            % (self.nVersion, repr_vector(self.vHave))
 
 
 class COutPoint:
@@ -285,14 +467,20 @@ class COutPoint:
         self.n = n
 
     def deserialize(self, f):
-        self.hash = deser_uint256(f)
-        self.n = struct.unpack("<I", f.read(4))[0]
+        f = as_reader(f)
+        self.hash = f.read_uint256()
+        self.n = f.unpack("<I")[0]
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += ser_uint256(self.hash)
+        buf += struct.pack("<I", self.n)
+        return buf
+
+    def clone(self):
+        return COutPoint(self.hash, self.n)
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
@@ -310,17 +498,26 @@ class CTxIn:
         self.nSequence = nSequence
 
     def deserialize(self, f):
+        f = as_reader(f)
         self.prevout = COutPoint()
         self.prevout.deserialize(f)
-        self.scriptSig = deser_string(f)
-        self.nSequence = struct.unpack("<I", f.read(4))[0]
+        self.scriptSig = f.read_string()
+        self.nSequence = f.unpack("<I")[0]
 
     def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        self.prevout.serialize_into(buf)
+        ser_string_into(buf, self.scriptSig)
+        buf += struct.pack("<I", self.nSequence)
+        return buf
+
+    # The clone() methods copy every mutable object but share the scripts and
+    # witness stack items, which are expected to be immutable bytes objects.
+    # They're much faster than copy.deepcopy().
+    def clone(self):
+        return CTxIn(self.prevout.clone(), self.scriptSig, self.nSequence)
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
@@ -336,14 +533,20 @@ class CTxOut:
         self.scriptPubKey = scriptPubKey
 
     def deserialize(self, f):
-        self.nValue = struct.unpack("<q", f.read(8))[0]
-        self.scriptPubKey = deser_string(f)
+        f = as_reader(f)
+        self.nValue = f.unpack("<q")[0]
+        self.scriptPubKey = f.read_string()
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.nValue)
-        r += ser_string(self.scriptPubKey)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<q", self.nValue)
+        ser_string_into(buf, self.scriptPubKey)
+        return buf
+
+    def clone(self):
+        return CTxOut(self.nValue, self.scriptPubKey)
 
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
@@ -358,9 +561,14 @@ class CScriptWitness:
         # stack is a vector of strings
         self.stack = []
 
+    def clone(self):
+        r = CScriptWitness()
+        r.stack = list(self.stack)
+        return r
+
     def __repr__(self):
         return "CScriptWitness(%s)" % \
-               (",".join([x.hex() for x in self.stack]))
+               (repr_join(self.stack, ",", lambda x: x.hex()))
 
     def is_null(self):
         if self.stack:
@@ -380,6 +588,14 @@ class CTxInWitness:
     def serialize(self):
         return ser_string_vector(self.scriptWitness.stack)
 
+    def serialize_into(self, buf):
+        return ser_string_vector_into(buf, self.scriptWitness.stack)
+
+    def clone(self):
+        r = CTxInWitness()
+        r.scriptWitness = self.scriptWitness.clone()
+        return r
+
     def __repr__(self):
         return repr(self.scriptWitness)
 
@@ -398,17 +614,24 @@ class CTxWitness:
             self.vtxinwit[i].deserialize(f)
 
     def serialize(self):
-        r = b""
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
         for x in self.vtxinwit:
-            r += x.serialize()
+            x.serialize_into(buf)
+        return buf
+
+    def clone(self):
+        r = CTxWitness()
+        r.vtxinwit = [x.clone() for x in self.vtxinwit]
         return r
 
     def __repr__(self):
         return "CTxWitness(%s)" % \
-               (';'.join([repr(x) for x in self.vtxinwit]))
+               (repr_join(self.vtxinwit, ';'))
 
     def is_null(self):
         for x in self.vtxinwit:
@@ -417,9 +640,15 @@ class CTxWitness:
         return True
 
 
+def _frozen(data):
+    """Return data as an immutable bytes object, for a cache key."""
+    return data if isinstance(data, bytes) else bytes(data)
+
+
 class CTransaction:
-    __slots__ = ("hash", "nLockTime", "nVersion", "sha256", "vin", "vout",
-                 "wit")
+    __slots__ = ("_cache_key", "_cache_ser", "_cache_ser_witness",
+                 "_cache_txid", "_cache_wtxid", "hash", "nLockTime",
+                 "nVersion", "sha256", "vin", "vout", "wit")
 
     def __init__(self, tx=None):
         if tx is None:
@@ -430,21 +659,33 @@ class CTransaction:
             self.nLockTime = 0
             self.sha256 = None
             self.hash = None
+            self.clear_cache()
         else:
             self.nVersion = tx.nVersion
-            self.vin = copy.deepcopy(tx.vin)
-            self.vout = copy.deepcopy(tx.vout)
+            self.vin = [i.clone() for i in tx.vin]
+            self.vout = [o.clone() for o in tx.vout]
             self.nLockTime = tx.nLockTime
             self.sha256 = tx.sha256
             self.hash = tx.hash
-            self.wit = copy.deepcopy(tx.wit)
+            self.wit = tx.wit.clone()
+            # The cache only holds immutable values and stays valid for as
+            # long as the copy matches the snapshot it was taken from.
+            self._cache_key = tx._cache_key
+            self._cache_ser = tx._cache_ser
+            self._cache_ser_witness = tx._cache_ser_witness
+            self._cache_txid = tx._cache_txid
+            self._cache_wtxid = tx._cache_wtxid
+
+    def clone(self):
+        return CTransaction(self)
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        f = as_reader(f)
+        self.nVersion = f.unpack("<i")[0]
         self.vin = deser_vector(f, CTxIn)
         flags = 0
         if len(self.vin) == 0:
-            flags = struct.unpack("<B", f.read(1))[0]
+            flags = f.unpack("<B")[0]
             # Not sure why flags can't be zero, but this
             # matches the implementation in bitcoind
             if (flags != 0):
@@ -457,45 +698,85 @@ class CTransaction:
             self.wit.deserialize(f)
         else:
             self.wit = CTxWitness()
-        self.nLockTime = struct.unpack("<I", f.read(4))[0]
+        self.nLockTime = f.unpack("<I")[0]
         self.sha256 = None
         self.hash = None
+        self.clear_cache()
+
+    # The serializations, txid and wtxid are cached together with a snapshot
+    # of every field they depend on (including those of the inputs, outputs
+    # and witnesses). Whenever the snapshot no longer matches, the cache is
+    # dropped, so mutating the transaction in any way invalidates it. Scripts
+    # and witness stack items that aren't bytes (eg a bytearray, which can be
+    # changed in place) are copied into the snapshot.
+    def clear_cache(self):
+        self._cache_key = None
+        self._cache_ser = None
+        self._cache_ser_witness = None
+        self._cache_txid = None
+        self._cache_wtxid = None
+
+    def _validate_cache(self):
+        key = (self.nVersion, self.nLockTime,
+               tuple([(i.prevout.hash, i.prevout.n, _frozen(i.scriptSig), i.nSequence) for i in self.vin]),
+               tuple([(o.nValue, _frozen(o.scriptPubKey)) for o in self.vout]),
+               tuple([tuple([_frozen(x) for x in w.scriptWitness.stack]) for w in self.wit.vtxinwit]))
+        if key != self._cache_key:
+            self.clear_cache()
+            self._cache_key = key
+
+    def _serialization(self, with_witness):
+        # Assumes the cache was validated
+        if with_witness:
+            if self._cache_ser_witness is None:
+                self._cache_ser_witness = bytes(self._serialize_uncached_into(bytearray(), True))
+            return self._cache_ser_witness
+        if self._cache_ser is None:
+            self._cache_ser = bytes(self._serialize_uncached_into(bytearray(), False))
+        return self._cache_ser
 
     def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        self._validate_cache()
+        return self._serialization(False)
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
+        self._validate_cache()
+        return self._serialization(True)
+
+    # Regular serialization is with witness -- must explicitly
+    # call serialize_without_witness to exclude witness data.
+    def serialize(self):
+        return self.serialize_with_witness()
+
+    def serialize_into(self, buf, with_witness=True):
+        # Go through the public methods, which subclasses may override
+        if with_witness:
+            buf += self.serialize_with_witness()
+        else:
+            buf += self.serialize_without_witness()
+        return buf
+
+    def _serialize_uncached_into(self, buf, with_witness):
         flags = 0
-        if not self.wit.is_null():
+        if with_witness and not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        buf += struct.pack("<i", self.nVersion)
         if flags:
             dummy = []
-            r += ser_vector(dummy)
-            r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
+            ser_vector_into(buf, dummy)
+            buf += struct.pack("<B", flags)
+        ser_vector_into(buf, self.vin)
+        ser_vector_into(buf, self.vout)
         if flags & 1:
             if (len(self.wit.vtxinwit) != len(self.vin)):
                 # vtxinwit must have the same length as vin
                 self.wit.vtxinwit = self.wit.vtxinwit[:len(self.vin)]
                 for i in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
-            r += self.wit.serialize()
-        r += struct.pack("<I", self.nLockTime)
-        return r
-
-    # Regular serialization is with witness -- must explicitly
-    # call serialize_without_witness to exclude witness data.
-    def serialize(self):
-        return self.serialize_with_witness()
+            self.wit.serialize_into(buf)
+        buf += struct.pack("<I", self.nLockTime)
+        return buf
 
     # Recalculate the txid (transaction hash without witness)
     def rehash(self):
@@ -506,13 +787,18 @@ class CTransaction:
     # We will only cache the serialization without witness in
     # self.sha256 and self.hash -- those are expected to be the txid.
     def calc_sha256(self, with_witness=False):
+        self._validate_cache()
         if with_witness:
-            # Don't cache the result, just return it
-            return uint256_from_str(hash256(self.serialize_with_witness()))
+            # Don't store the result in self.sha256, just return it
+            if self._cache_wtxid is None:
+                self._cache_wtxid = uint256_from_str(hash256(self.serialize_with_witness()))
+            return self._cache_wtxid
 
+        if self._cache_txid is None:
+            self._cache_txid = hash256(self.serialize_without_witness())
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = encode(hash256(self.serialize_without_witness())[::-1], 'hex_codec').decode('ascii')
+            self.sha256 = uint256_from_str(self._cache_txid)
+        self.hash = encode(self._cache_txid[::-1], 'hex_codec').decode('ascii')
 
     def is_valid(self):
         self.calc_sha256()
@@ -523,7 +809,156 @@ class CTransaction:
 
     def __repr__(self):
         return "CTransaction(nVersion=%i vin=%s vout=%s wit=%s nLockTime=%i)" \
-            % (self.nVersion, repr(self.vin), repr(self.vout), repr(self.wit), self.nLockTime)
+            % (self.nVersion, repr_vector(self.vin), repr_vector(self.vout), repr(self.wit), self.nLockTime)
+
+
+class TxBatch:
+    """A list of transactions stored as flat arrays rather than CTransactions.
+
+    Each transaction, input and output takes one entry in the arrays below.
+    Scripts, prevout hashes and serialized witness stacks are packed into
+    bytearrays and located through offset arrays, where item i spans
+    offsets[i]:offsets[i + 1]. This keeps the memory used by very large
+    batches small and lets them be serialized and hashed in one pass.
+    Transactions are only turned into CTransaction objects on request."""
+    __slots__ = ("nLockTime", "nVersion", "prevout_hash", "prevout_n",
+                 "scriptPubKey", "scriptPubKey_offsets", "scriptSig",
+                 "scriptSig_offsets", "nSequence", "nValue", "vin_offsets",
+                 "vout_offsets", "witness", "witness_offsets")
+
+    _no_witness = b"\x00"  # serialization of an empty witness stack
+
+    def __init__(self, txs=()):
+        # Per transaction
+        self.nVersion = array("i")
+        self.nLockTime = array("I")
+        self.vin_offsets = array("Q", [0])
+        self.vout_offsets = array("Q", [0])
+        # Per input
+        self.prevout_hash = bytearray()
+        self.prevout_n = array("I")
+        self.scriptSig = bytearray()
+        self.scriptSig_offsets = array("Q", [0])
+        self.nSequence = array("I")
+        self.witness = bytearray()
+        self.witness_offsets = array("Q", [0])
+        # Per output
+        self.nValue = array("q")
+        self.scriptPubKey = bytearray()
+        self.scriptPubKey_offsets = array("Q", [0])
+        for tx in txs:
+            self.append(tx)
+
+    def __len__(self):
+        return len(self.nVersion)
+
+    def add_transaction(self, nVersion=1, nLockTime=0):
+        """Start a new, empty transaction. add_input()/add_output() add to it."""
+        self.nVersion.append(nVersion)
+        self.nLockTime.append(nLockTime)
+        self.vin_offsets.append(self.vin_offsets[-1])
+        self.vout_offsets.append(self.vout_offsets[-1])
+        return len(self.nVersion) - 1
+
+    def add_input(self, prevout_hash, prevout_n, scriptSig=b"", nSequence=0, witness_stack=()):
+        self.prevout_hash += ser_uint256(prevout_hash)
+        self.prevout_n.append(prevout_n)
+        self.scriptSig += scriptSig
+        self.scriptSig_offsets.append(len(self.scriptSig))
+        self.nSequence.append(nSequence)
+        self.witness += ser_string_vector(witness_stack) if witness_stack else self._no_witness
+        self.witness_offsets.append(len(self.witness))
+        self.vin_offsets[-1] += 1
+
+    def add_output(self, nValue, scriptPubKey):
+        self.nValue.append(nValue)
+        self.scriptPubKey += scriptPubKey
+        self.scriptPubKey_offsets.append(len(self.scriptPubKey))
+        self.vout_offsets[-1] += 1
+
+    def append(self, tx):
+        """Append a copy of a CTransaction."""
+        self.add_transaction(tx.nVersion, tx.nLockTime)
+        vtxinwit = tx.wit.vtxinwit
+        for i, txin in enumerate(tx.vin):
+            stack = vtxinwit[i].scriptWitness.stack if i < len(vtxinwit) else ()
+            self.add_input(txin.prevout.hash, txin.prevout.n, txin.scriptSig, txin.nSequence, stack)
+        for txout in tx.vout:
+            self.add_output(txout.nValue, txout.scriptPubKey)
+
+    def get_transaction(self, i):
+        """Return transaction i as a new CTransaction."""
+        tx = CTransaction()
+        tx.nVersion = self.nVersion[i]
+        tx.nLockTime = self.nLockTime[i]
+        has_witness = False
+        for j in range(self.vin_offsets[i], self.vin_offsets[i + 1]):
+            prevout = COutPoint(int.from_bytes(self.prevout_hash[32 * j:32 * j + 32], 'little'), self.prevout_n[j])
+            script = bytes(self.scriptSig[self.scriptSig_offsets[j]:self.scriptSig_offsets[j + 1]])
+            tx.vin.append(CTxIn(prevout, script, self.nSequence[j]))
+            inwit = CTxInWitness()
+            inwit.scriptWitness.stack = deser_string_vector(BytesReader(bytes(self.witness[self.witness_offsets[j]:self.witness_offsets[j + 1]])))
+            has_witness |= bool(inwit.scriptWitness.stack)
+            tx.wit.vtxinwit.append(inwit)
+        if not has_witness:
+            tx.wit = CTxWitness()
+        for k in range(self.vout_offsets[i], self.vout_offsets[i + 1]):
+            script = bytes(self.scriptPubKey[self.scriptPubKey_offsets[k]:self.scriptPubKey_offsets[k + 1]])
+            tx.vout.append(CTxOut(self.nValue[k], script))
+        return tx
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get_transaction(i)
+
+    def serialize_into(self, buf, i, with_witness=True):
+        """Append the serialization of transaction i to buf."""
+        vin_begin, vin_end = self.vin_offsets[i], self.vin_offsets[i + 1]
+        witness_begin, witness_end = self.witness_offsets[vin_begin], self.witness_offsets[vin_end]
+        # Same as CTxWitness.is_null(): an empty stack serializes to a single
+        # byte, so some stack is non-empty iff the witnesses are any longer.
+        with_witness = with_witness and witness_end - witness_begin != vin_end - vin_begin
+        pack_I = _structs["<I"].pack
+        buf += _structs["<i"].pack(self.nVersion[i])
+        if with_witness:
+            buf += b"\x00\x01"
+        ser_compact_size_into(buf, vin_end - vin_begin)
+        for j in range(vin_begin, vin_end):
+            buf += self.prevout_hash[32 * j:32 * j + 32]
+            buf += pack_I(self.prevout_n[j])
+            ser_string_into(buf, self.scriptSig[self.scriptSig_offsets[j]:self.scriptSig_offsets[j + 1]])
+            buf += pack_I(self.nSequence[j])
+        vout_begin, vout_end = self.vout_offsets[i], self.vout_offsets[i + 1]
+        ser_compact_size_into(buf, vout_end - vout_begin)
+        pack_q = _structs["<q"].pack
+        for k in range(vout_begin, vout_end):
+            buf += pack_q(self.nValue[k])
+            ser_string_into(buf, self.scriptPubKey[self.scriptPubKey_offsets[k]:self.scriptPubKey_offsets[k + 1]])
+        if with_witness:
+            buf += self.witness[witness_begin:witness_end]
+        buf += pack_I(self.nLockTime[i])
+        return buf
+
+    def serialize(self, i, with_witness=True):
+        return bytes(self.serialize_into(bytearray(), i, with_witness))
+
+    def to_hex(self, with_witness=True):
+        """Return the hex serialization of every transaction, in order."""
+        buf = bytearray()
+        result = []
+        for i in range(len(self)):
+            result.append(self.serialize_into(buf, i, with_witness).hex())
+            del buf[:]
+        return result
+
+    def calc_sha256(self, with_witness=False):
+        """Return the txid (or wtxid) of every transaction as integers, in order."""
+        buf = bytearray()
+        result = []
+        for i in range(len(self)):
+            result.append(uint256_from_str(hash256(self.serialize_into(buf, i, with_witness))))
+            del buf[:]
+        return result
 
 
 class CBlockHeader:
@@ -555,34 +990,32 @@ class CBlockHeader:
         self.hash = None
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.hashPrevBlock = deser_uint256(f)
-        self.hashMerkleRoot = deser_uint256(f)
-        self.nTime = struct.unpack("<I", f.read(4))[0]
-        self.nBits = struct.unpack("<I", f.read(4))[0]
-        self.nNonce = struct.unpack("<I", f.read(4))[0]
+        f = as_reader(f)
+        self.nVersion = f.unpack("<i")[0]
+        self.hashPrevBlock = f.read_uint256()
+        self.hashMerkleRoot = f.read_uint256()
+        self.nTime = f.unpack("<I")[0]
+        self.nBits = f.unpack("<I")[0]
+        self.nNonce = f.unpack("<I")[0]
         self.sha256 = None
         self.hash = None
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-        r += struct.pack("<I", self.nNonce)
-        return r
+        # Always the header alone, also for a CBlock via super(CBlock, block)
+        return bytes(CBlockHeader.serialize_into(self, bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<i", self.nVersion)
+        buf += ser_uint256(self.hashPrevBlock)
+        buf += ser_uint256(self.hashMerkleRoot)
+        buf += struct.pack("<I", self.nTime)
+        buf += struct.pack("<I", self.nBits)
+        buf += struct.pack("<I", self.nNonce)
+        return buf
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-            r += struct.pack("<I", self.nNonce)
+            r = CBlockHeader.serialize_into(self, bytearray())
             self.sha256 = uint256_from_str(hash256(r))
             self.hash = encode(hash256(r)[::-1], 'hex_codec').decode('ascii')
 
@@ -599,24 +1032,156 @@ class CBlockHeader:
 BLOCK_HEADER_SIZE = len(CBlockHeader().serialize())
 assert_equal(BLOCK_HEADER_SIZE, 80)
 
+class MerkleTree:
+    """Merkle tree over 32-byte leaf digests that is kept between updates.
+
+    levels[0] holds the leaves and levels[-1] the single root node. As in
+    bitcoind, a level with an odd number of nodes pairs its last node with
+    itself. Appending or replacing a leaf only rehashes the O(log n) nodes on
+    its path to the root."""
+    __slots__ = ("levels",)
+
+    def __init__(self, leaves=()):
+        self.levels = [[]]
+        self.update(list(leaves))
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def _rehash(self, dirty):
+        """Recompute the parents of the nodes in dirty (sorted leaf indices), level by level.
+
+        Each parent is hashed once, so a full build takes n - 1 hashes and a
+        single changed leaf log2(n)."""
+        levels = self.levels
+        height = 0
+        while len(levels[height]) > 1:
+            level = levels[height]
+            if height + 1 == len(levels):
+                levels.append([])
+            parent = levels[height + 1]
+            old_size = len(parent)
+            size = (len(level) + 1) // 2
+            if len(dirty) == len(level):
+                dirty = range(size)
+            else:
+                dirty = sorted(set(i >> 1 for i in dirty))
+                if size != old_size and (not dirty or dirty[-1] != size - 1):
+                    # The last node pairs with a different sibling (or itself) now
+                    dirty.append(size - 1)
+            del parent[size:]
+            parent.extend([None] * (size - len(parent)))
+            last = len(level) - 1
+            for i in dirty:
+                left = 2 * i
+                parent[i] = hash256(level[left] + level[min(left + 1, last)])
+            height += 1
+        del levels[height + 1:]
+
+    def append(self, leaf):
+        self.levels[0].append(leaf)
+        self._rehash([len(self.levels[0]) - 1])
+
+    def replace(self, index, leaf):
+        if self.levels[0][index] != leaf:
+            self.levels[0][index] = leaf
+            self._rehash([index])
+
+    def update(self, leaves):
+        """Make the tree match leaves, rehashing only the nodes that changed."""
+        current = self.levels[0]
+        if not current:
+            current.extend(leaves)
+            self._rehash(range(len(leaves)))
+            return
+        if not leaves:
+            self.levels = [[]]
+            return
+        old_size = len(current)
+        dirty = [i for i in range(min(old_size, len(leaves))) if current[i] != leaves[i]]
+        if len(leaves) != old_size:
+            del current[len(leaves):]
+            current.extend(leaves[old_size:])
+            # The new leaves, and the old last leaf, whose sibling may have changed
+            first = min(old_size, len(leaves)) - 1
+            dirty.extend(range(max(first, dirty[-1] + 1 if dirty else 0), len(leaves)))
+        for i in dirty:
+            current[i] = leaves[i]
+        if dirty:
+            self._rehash(dirty)
+
+    def root(self):
+        return uint256_from_str(self.levels[-1][0])
+
+    def get_branch(self, index):
+        """Return the sibling digests from leaf index up to the root."""
+        branch = []
+        for level in self.levels[:-1]:
+            branch.append(level[min(index ^ 1, len(level) - 1)])
+            index >>= 1
+        return branch
+
+    def get_partial_merkle_tree(self, matches):
+        """Build a CPartialMerkleTree (BIP37) proving the leaves flagged in matches."""
+        tree = CPartialMerkleTree()
+        tree.nTransactions = len(self.levels[0])
+
+        def traverse(height, pos):
+            start = pos << height
+            parent_of_match = any(matches[start:min((pos + 1) << height, tree.nTransactions)])
+            tree.vBits.append(parent_of_match)
+            if height == 0 or not parent_of_match:
+                tree.vHash.append(uint256_from_str(self.levels[height][pos]))
+            else:
+                traverse(height - 1, pos * 2)
+                if pos * 2 + 1 < len(self.levels[height - 1]):
+                    traverse(height - 1, pos * 2 + 1)
+
+        traverse(len(self.levels) - 1, 0)
+        return tree
+
+
 class CBlock(CBlockHeader):
-    __slots__ = ("vtx",)
+    __slots__ = ("merkle_tree", "vtx", "witness_merkle_tree")
 
     def __init__(self, header=None):
         super().__init__(header)
         self.vtx = []
+        # Kept in sync with vtx by calc_merkle_root() and
+        # calc_witness_merkle_root(), which only rehash changed leaves.
+        self.merkle_tree = MerkleTree()
+        self.witness_merkle_tree = MerkleTree()
 
     def deserialize(self, f):
+        if isinstance(f, BytesIO):
+            # Decode straight out of the stream's buffer instead of read()ing
+            # every field, then move the stream past the bytes consumed.
+            view = f.getbuffer()
+            try:
+                r = BytesReader(view, f.tell())
+                self.deserialize(r)
+            finally:
+                view.release()
+            f.seek(r.pos)
+            return
+        f = as_reader(f)
         super().deserialize(f)
         self.vtx = deser_vector(f, CTransaction)
 
     def serialize(self, with_witness=True):
-        r = b""
-        r += super().serialize()
+        return bytes(self.serialize_into(bytearray(), with_witness))
+
+    def serialize_into(self, buf, with_witness=True):
+        super().serialize_into(buf)
         if with_witness:
-            r += ser_vector(self.vtx, "serialize_with_witness")
+            ser_vector_into(buf, self.vtx, "serialize_with_witness")
         else:
-            r += ser_vector(self.vtx, "serialize_without_witness")
+            ser_vector_into(buf, self.vtx, "serialize_without_witness")
+        return buf
+
+    def clone(self):
+        r = CBlock(self)
+        r.vtx = [tx.clone() for tx in self.vtx]
         return r
 
     # Calculate the merkle root given a vector of transaction hashes
@@ -635,7 +1200,8 @@ class CBlock(CBlockHeader):
         for tx in self.vtx:
             tx.calc_sha256()
             hashes.append(ser_uint256(tx.sha256))
-        return self.get_merkle_root(hashes)
+        self.merkle_tree.update(hashes)
+        return self.merkle_tree.root()
 
     def calc_witness_merkle_root(self):
         # For witness root purposes, the hash of the
@@ -646,7 +1212,8 @@ class CBlock(CBlockHeader):
             # Calculate the hashes with witness data
             hashes.append(ser_uint256(tx.calc_sha256(True)))
 
-        return self.get_merkle_root(hashes)
+        self.witness_merkle_tree.update(hashes)
+        return self.witness_merkle_tree.root()
 
     def is_valid(self):
         self.calc_sha256()
@@ -670,7 +1237,39 @@ class CBlock(CBlockHeader):
     def __repr__(self):
         return "CBlock(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x nTime=%s nBits=%08x nNonce=%08x vtx=%s)" \
             % (self.nVersion, self.hashPrevBlock, self.hashMerkleRoot,
-               time.ctime(self.nTime), self.nBits, self.nNonce, repr(self.vtx))
+               time.ctime(self.nTime), self.nBits, self.nNonce, repr_vector(self.vtx))
+
+
+class CLazyBlock(CBlock):
+    """A CBlock that only decodes its header when deserialized.
+
+    The serialized transactions are kept as raw bytes and decoded the first
+    time vtx is used, so tests that only look at the block hash don't pay for
+    parsing every transaction. P2PConnection uses it for received blocks."""
+    __slots__ = ("_vtx_data",)
+
+    def __init__(self, header=None):
+        self._vtx_data = None
+        super().__init__(header)
+
+    def deserialize(self, f):
+        f = as_reader(f)
+        CBlockHeader.deserialize(self, f)
+        self.vtx = []
+        self._vtx_data = f.read()
+
+    @property
+    def vtx(self):
+        data = self._vtx_data
+        if data is not None:
+            CBlock.vtx.__set__(self, deser_vector(BytesReader(data), CTransaction))
+            self._vtx_data = None
+        return CBlock.vtx.__get__(self)
+
+    @vtx.setter
+    def vtx(self, vtx):
+        self._vtx_data = None
+        CBlock.vtx.__set__(self, vtx)
 
 
 class PrefilledTransaction:
@@ -681,18 +1280,21 @@ class PrefilledTransaction:
         self.tx = tx
 
     def deserialize(self, f):
-        self.index = deser_compact_size(f)
+        f = as_reader(f)
+        self.index = f.read_compact_size()
         self.tx = CTransaction()
         self.tx.deserialize(f)
 
     def serialize(self, with_witness=True):
-        r = b""
-        r += ser_compact_size(self.index)
+        return bytes(self.serialize_into(bytearray(), with_witness))
+
+    def serialize_into(self, buf, with_witness=True):
+        ser_compact_size_into(buf, self.index)
         if with_witness:
-            r += self.tx.serialize_with_witness()
+            buf += self.tx.serialize_with_witness()
         else:
-            r += self.tx.serialize_without_witness()
-        return r
+            buf += self.tx.serialize_without_witness()
+        return buf
 
     def serialize_without_witness(self):
         return self.serialize(with_witness=False)
@@ -718,9 +1320,10 @@ class P2PHeaderAndShortIDs:
         self.prefilled_txn = []
 
     def deserialize(self, f):
+        f = as_reader(f)
         self.header.deserialize(f)
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
-        self.shortids_length = deser_compact_size(f)
+        self.nonce = f.unpack("<Q")[0]
+        self.shortids_length = f.read_compact_size()
         for i in range(self.shortids_length):
             # shortids are defined to be 6 bytes in the spec, so append
             # two zero bytes and read it in as an 8-byte number
@@ -730,21 +1333,23 @@ class P2PHeaderAndShortIDs:
 
     # When using version 2 compact blocks, we must serialize with_witness.
     def serialize(self, with_witness=False):
-        r = b""
-        r += self.header.serialize()
-        r += struct.pack("<Q", self.nonce)
-        r += ser_compact_size(self.shortids_length)
+        return bytes(self.serialize_into(bytearray(), with_witness))
+
+    def serialize_into(self, buf, with_witness=False):
+        self.header.serialize_into(buf)
+        buf += struct.pack("<Q", self.nonce)
+        ser_compact_size_into(buf, self.shortids_length)
         for x in self.shortids:
             # We only want the first 6 bytes
-            r += struct.pack("<Q", x)[0:6]
+            buf += struct.pack("<Q", x)[0:6]
         if with_witness:
-            r += ser_vector(self.prefilled_txn, "serialize_with_witness")
+            ser_vector_into(buf, self.prefilled_txn, "serialize_with_witness")
         else:
-            r += ser_vector(self.prefilled_txn, "serialize_without_witness")
-        return r
+            ser_vector_into(buf, self.prefilled_txn, "serialize_without_witness")
+        return buf
 
     def __repr__(self):
-        return "P2PHeaderAndShortIDs(header=%s, nonce=%d, shortids_length=%d, shortids=%s, prefilled_txn_length=%d, prefilledtxn=%s" % (repr(self.header), self.nonce, self.shortids_length, repr(self.shortids), self.prefilled_txn_length, repr(self.prefilled_txn))
+        return "P2PHeaderAndShortIDs(header=%s, nonce=%d, shortids_length=%d, shortids=%s, prefilled_txn_length=%d, prefilledtxn=%s" % (repr(self.header), self.nonce, self.shortids_length, repr_vector(self.shortids), self.prefilled_txn_length, repr_vector(self.prefilled_txn))
 
 
 # P2P version of the above that will use witness serialization (for compact
@@ -754,6 +1359,9 @@ class P2PHeaderAndShortWitnessIDs(P2PHeaderAndShortIDs):
     def serialize(self):
         return super().serialize(with_witness=True)
 
+    def serialize_into(self, buf, with_witness=True):
+        return super().serialize_into(buf, with_witness)
+
 # Calculate the BIP 152-compact blocks shortid for a given transaction hash
 def calculate_shortid(k0, k1, tx_hash):
     expected_shortid = siphash256(k0, k1, tx_hash)
@@ -817,15 +1425,19 @@ class HeaderAndShortIDs:
         self.shortids = []
         self.use_witness = use_witness
         [k0, k1] = self.get_siphash_keys()
+        prefilled = set(prefill_list)
+        tx_hashes = []
         for i in range(len(block.vtx)):
-            if i not in prefill_list:
+            if i not in prefilled:
                 tx_hash = block.vtx[i].sha256
                 if use_witness:
                     tx_hash = block.vtx[i].calc_sha256(with_witness=True)
-                self.shortids.append(calculate_shortid(k0, k1, tx_hash))
+                tx_hashes.append(tx_hash)
+        # Same as calculate_shortid(), for all the transactions at once
+        self.shortids = [h & 0x0000ffffffffffff for h in siphash256_batch(k0, k1, tx_hashes)]
 
     def __repr__(self):
-        return "HeaderAndShortIDs(header=%s, nonce=%d, shortids=%s, prefilledtxn=%s" % (repr(self.header), self.nonce, repr(self.shortids), repr(self.prefilled_txn))
+        return "HeaderAndShortIDs(header=%s, nonce=%d, shortids=%s, prefilledtxn=%s" % (repr(self.header), self.nonce, repr_vector(self.shortids), repr_vector(self.prefilled_txn))
 
 
 class BlockTransactionsRequest:
@@ -836,18 +1448,21 @@ class BlockTransactionsRequest:
         self.indexes = indexes if indexes is not None else []
 
     def deserialize(self, f):
-        self.blockhash = deser_uint256(f)
-        indexes_length = deser_compact_size(f)
+        f = as_reader(f)
+        self.blockhash = f.read_uint256()
+        indexes_length = f.read_compact_size()
         for i in range(indexes_length):
-            self.indexes.append(deser_compact_size(f))
+            self.indexes.append(f.read_compact_size())
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.blockhash)
-        r += ser_compact_size(len(self.indexes))
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += ser_uint256(self.blockhash)
+        ser_compact_size_into(buf, len(self.indexes))
         for x in self.indexes:
-            r += ser_compact_size(x)
-        return r
+            ser_compact_size_into(buf, x)
+        return buf
 
     # helper to set the differentially encoded indexes from absolute ones
     def from_absolute(self, absolute_indexes):
@@ -877,20 +1492,23 @@ class BlockTransactions:
         self.transactions = transactions if transactions is not None else []
 
     def deserialize(self, f):
-        self.blockhash = deser_uint256(f)
+        f = as_reader(f)
+        self.blockhash = f.read_uint256()
         self.transactions = deser_vector(f, CTransaction)
 
     def serialize(self, with_witness=True):
-        r = b""
-        r += ser_uint256(self.blockhash)
+        return bytes(self.serialize_into(bytearray(), with_witness))
+
+    def serialize_into(self, buf, with_witness=True):
+        buf += ser_uint256(self.blockhash)
         if with_witness:
-            r += ser_vector(self.transactions, "serialize_with_witness")
+            ser_vector_into(buf, self.transactions, "serialize_with_witness")
         else:
-            r += ser_vector(self.transactions, "serialize_without_witness")
-        return r
+            ser_vector_into(buf, self.transactions, "serialize_without_witness")
+        return buf
 
     def __repr__(self):
-        return "BlockTransactions(hash=%064x transactions=%s)" % (self.blockhash, repr(self.transactions))
+        return "BlockTransactions(hash=%064x transactions=%s)" % (self.blockhash, repr_vector(self.transactions))
 
 
 class CPartialMerkleTree:
@@ -902,25 +1520,28 @@ class CPartialMerkleTree:
         self.vBits = []
 
     def deserialize(self, f):
-        self.nTransactions = struct.unpack("<i", f.read(4))[0]
+        f = as_reader(f)
+        self.nTransactions = f.unpack("<i")[0]
         self.vHash = deser_uint256_vector(f)
-        vBytes = deser_string(f)
+        vBytes = f.read_string()
         self.vBits = []
         for i in range(len(vBytes) * 8):
             self.vBits.append(vBytes[i//8] & (1 << (i % 8)) != 0)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nTransactions)
-        r += ser_uint256_vector(self.vHash)
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<i", self.nTransactions)
+        ser_uint256_vector_into(buf, self.vHash)
         vBytesArray = bytearray([0x00] * ((len(self.vBits) + 7)//8))
         for i in range(len(self.vBits)):
             vBytesArray[i // 8] |= self.vBits[i] << (i % 8)
-        r += ser_string(bytes(vBytesArray))
-        return r
+        ser_string_into(buf, vBytesArray)
+        return buf
 
     def __repr__(self):
-        return "CPartialMerkleTree(nTransactions=%d, vHash=%s, vBits=%s)" % (self.nTransactions, repr(self.vHash), repr(self.vBits))
+        return "CPartialMerkleTree(nTransactions=%d, vHash=%s, vBits=%s)" % (self.nTransactions, repr_vector(self.vHash), repr_vector(self.vBits))
 
 
 class CMerkleBlock:
@@ -931,14 +1552,17 @@ class CMerkleBlock:
         self.txn = CPartialMerkleTree()
 
     def deserialize(self, f):
+        f = as_reader(f)
         self.header.deserialize(f)
         self.txn.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.header.serialize()
-        r += self.txn.serialize()
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        self.header.serialize_into(buf)
+        self.txn.serialize_into(buf)
+        return buf
 
     def __repr__(self):
         return "CMerkleBlock(header=%s, txn=%s)" % (repr(self.header), repr(self.txn))
@@ -962,40 +1586,43 @@ class msg_version:
         self.nRelay = MY_RELAY
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
-        self.nTime = struct.unpack("<q", f.read(8))[0]
+        f = as_reader(f)
+        self.nVersion = f.unpack("<i")[0]
+        self.nServices = f.unpack("<Q")[0]
+        self.nTime = f.unpack("<q")[0]
         self.addrTo = CAddress()
         self.addrTo.deserialize(f, False)
 
         self.addrFrom = CAddress()
         self.addrFrom.deserialize(f, False)
-        self.nNonce = struct.unpack("<Q", f.read(8))[0]
-        self.strSubVer = deser_string(f)
+        self.nNonce = f.unpack("<Q")[0]
+        self.strSubVer = f.read_string()
 
-        self.nStartingHeight = struct.unpack("<i", f.read(4))[0]
+        self.nStartingHeight = f.unpack("<i")[0]
 
         if self.nVersion >= 70001:
             # Relay field is optional for version 70001 onwards
             try:
-                self.nRelay = struct.unpack("<b", f.read(1))[0]
+                self.nRelay = f.unpack("<b")[0]
             except:
                 self.nRelay = 0
         else:
             self.nRelay = 0
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<Q", self.nServices)
-        r += struct.pack("<q", self.nTime)
-        r += self.addrTo.serialize(False)
-        r += self.addrFrom.serialize(False)
-        r += struct.pack("<Q", self.nNonce)
-        r += ser_string(self.strSubVer)
-        r += struct.pack("<i", self.nStartingHeight)
-        r += struct.pack("<b", self.nRelay)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<i", self.nVersion)
+        buf += struct.pack("<Q", self.nServices)
+        buf += struct.pack("<q", self.nTime)
+        self.addrTo.serialize_into(buf, False)
+        self.addrFrom.serialize_into(buf, False)
+        buf += struct.pack("<Q", self.nNonce)
+        ser_string_into(buf, self.strSubVer)
+        buf += struct.pack("<i", self.nStartingHeight)
+        buf += struct.pack("<b", self.nRelay)
+        return buf
 
     def __repr__(self):
         return 'msg_version(nVersion=%i nServices=%i nTime=%s addrTo=%s addrFrom=%s nNonce=0x%016X strSubVer=%s nStartingHeight=%i nRelay=%i)' \
@@ -1017,6 +1644,9 @@ class msg_verack:
     def serialize(self):
         return b""
 
+    def serialize_into(self, buf):
+        return buf
+
     def __repr__(self):
         return "msg_verack()"
 
@@ -1034,8 +1664,11 @@ class msg_addr:
     def serialize(self):
         return ser_vector(self.addrs)
 
+    def serialize_into(self, buf):
+        return ser_vector_into(buf, self.addrs)
+
     def __repr__(self):
-        return "msg_addr(addrs=%s)" % (repr(self.addrs))
+        return "msg_addr(addrs=%s)" % (repr_vector(self.addrs))
 
 
 class msg_inv:
@@ -1049,13 +1682,16 @@ class msg_inv:
             self.inv = inv
 
     def deserialize(self, f):
-        self.inv = deser_vector(f, CInv)
+        self.inv = deser_inv_vector(f)
 
     def serialize(self):
         return ser_vector(self.inv)
 
+    def serialize_into(self, buf):
+        return ser_vector_into(buf, self.inv)
+
     def __repr__(self):
-        return "msg_inv(inv=%s)" % (repr(self.inv))
+        return "msg_inv(inv=%s)" % (repr_vector(self.inv))
 
 
 class msg_getdata:
@@ -1066,13 +1702,16 @@ class msg_getdata:
         self.inv = inv if inv is not None else []
 
     def deserialize(self, f):
-        self.inv = deser_vector(f, CInv)
+        self.inv = deser_inv_vector(f)
 
     def serialize(self):
         return ser_vector(self.inv)
 
+    def serialize_into(self, buf):
+        return ser_vector_into(buf, self.inv)
+
     def __repr__(self):
-        return "msg_getdata(inv=%s)" % (repr(self.inv))
+        return "msg_getdata(inv=%s)" % (repr_vector(self.inv))
 
 
 class msg_getblocks:
@@ -1084,15 +1723,18 @@ class msg_getblocks:
         self.hashstop = 0
 
     def deserialize(self, f):
+        f = as_reader(f)
         self.locator = CBlockLocator()
         self.locator.deserialize(f)
-        self.hashstop = deser_uint256(f)
+        self.hashstop = f.read_uint256()
 
     def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        self.locator.serialize_into(buf)
+        buf += ser_uint256(self.hashstop)
+        return buf
 
     def __repr__(self):
         return "msg_getblocks(locator=%s hashstop=%064x)" \
@@ -1112,6 +1754,10 @@ class msg_tx:
     def serialize(self):
         return self.tx.serialize_with_witness()
 
+    def serialize_into(self, buf):
+        buf += self.tx.serialize_with_witness()
+        return buf
+
     def __repr__(self):
         return "msg_tx(tx=%s)" % (repr(self.tx))
 
@@ -1122,6 +1768,10 @@ class msg_no_witness_tx(msg_tx):
     def serialize(self):
         return self.tx.serialize_without_witness()
 
+    def serialize_into(self, buf):
+        buf += self.tx.serialize_without_witness()
+        return buf
+
 
 class msg_block:
     __slots__ = ("block",)
@@ -1139,6 +1789,10 @@ class msg_block:
     def serialize(self):
         return self.block.serialize()
 
+    def serialize_into(self, buf):
+        buf += self.block.serialize()
+        return buf
+
     def __repr__(self):
         return "msg_block(block=%s)" % (repr(self.block))
 
@@ -1155,15 +1809,31 @@ class msg_generic:
     def serialize(self):
         return self.data
 
+    def serialize_into(self, buf):
+        buf += self.data
+        return buf
+
     def __repr__(self):
         return "msg_generic()"
 
 
+class msg_lazy_block(msg_block):
+    """A msg_block that decodes into a CLazyBlock."""
+    __slots__ = ()
+
+    def __init__(self, block=None):
+        super().__init__(CLazyBlock() if block is None else block)
+
+
 class msg_no_witness_block(msg_block):
     __slots__ = ()
     def serialize(self):
         return self.block.serialize(with_witness=False)
 
+    def serialize_into(self, buf):
+        buf += self.block.serialize(with_witness=False)
+        return buf
+
 
 class msg_getaddr:
     __slots__ = ()
@@ -1178,6 +1848,9 @@ class msg_getaddr:
     def serialize(self):
         return b""
 
+    def serialize_into(self, buf):
+        return buf
+
     def __repr__(self):
         return "msg_getaddr()"
 
@@ -1190,12 +1863,15 @@ class msg_ping:
         self.nonce = nonce
 
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        f = as_reader(f)
+        self.nonce = f.unpack("<Q")[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<Q", self.nonce)
+        return buf
 
     def __repr__(self):
         return "msg_ping(nonce=%08x)" % self.nonce
@@ -1209,12 +1885,15 @@ class msg_pong:
         self.nonce = nonce
 
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        f = as_reader(f)
+        self.nonce = f.unpack("<Q")[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<Q", self.nonce)
+        return buf
 
     def __repr__(self):
         return "msg_pong(nonce=%08x)" % self.nonce
@@ -1233,6 +1912,9 @@ class msg_mempool:
     def serialize(self):
         return b""
 
+    def serialize_into(self, buf):
+        return buf
+
     def __repr__(self):
         return "msg_mempool()"
 
@@ -1245,13 +1927,16 @@ class msg_notfound:
         self.vec = vec or []
 
     def deserialize(self, f):
-        self.vec = deser_vector(f, CInv)
+        self.vec = deser_inv_vector(f)
 
     def serialize(self):
         return ser_vector(self.vec)
 
+    def serialize_into(self, buf):
+        return ser_vector_into(buf, self.vec)
+
     def __repr__(self):
-        return "msg_notfound(vec=%s)" % (repr(self.vec))
+        return "msg_notfound(vec=%s)" % (repr_vector(self.vec))
 
 
 class msg_sendheaders:
@@ -1267,6 +1952,9 @@ class msg_sendheaders:
     def serialize(self):
         return b""
 
+    def serialize_into(self, buf):
+        return buf
+
     def __repr__(self):
         return "msg_sendheaders()"
 
@@ -1284,15 +1972,18 @@ class msg_getheaders:
         self.hashstop = 0
 
     def deserialize(self, f):
+        f = as_reader(f)
         self.locator = CBlockLocator()
         self.locator.deserialize(f)
-        self.hashstop = deser_uint256(f)
+        self.hashstop = f.read_uint256()
 
     def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        self.locator.serialize_into(buf)
+        buf += ser_uint256(self.hashstop)
+        return buf
 
     def __repr__(self):
         return "msg_getheaders(locator=%s, stop=%064x)" \
@@ -1309,17 +2000,56 @@ class msg_headers:
         self.headers = headers if headers is not None else []
 
     def deserialize(self, f):
-        # comment in bitcoind indicates these should be deserialized as blocks
-        blocks = deser_vector(f, CBlock)
-        for x in blocks:
-            self.headers.append(CBlockHeader(x))
+        f = as_reader(f)
+        # comment in bitcoind indicates these should be deserialized as blocks,
+        # but only the header of each is kept
+        for i in range(f.read_compact_size()):
+            header = CBlockHeader()
+            header.deserialize(f)
+            deser_vector(f, CTransaction)
+            header.calc_sha256()
+            self.headers.append(header)
+
+    def serialize(self):
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        # Each header is serialized as a block with no transactions
+        ser_compact_size_into(buf, len(self.headers))
+        for x in self.headers:
+            CBlockHeader.serialize_into(x, buf)
+            ser_compact_size_into(buf, 0)
+        return buf
+
+    def __repr__(self):
+        return "msg_headers(headers=%s)" % repr_vector(self.headers)
+
+
+class msg_raw_headers:
+    """A headers message of already serialized 80 byte block headers (eg from
+    blocktools.HeaderChain), which are sent without building a CBlockHeader
+    for each of them."""
+    __slots__ = ("raw_headers",)
+    msgtype = b"headers"
+
+    def __init__(self, raw_headers=b""):
+        assert len(raw_headers) % 80 == 0
+        self.raw_headers = bytes(raw_headers)
 
     def serialize(self):
-        blocks = [CBlock(x) for x in self.headers]
-        return ser_vector(blocks)
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        raw = self.raw_headers
+        ser_compact_size_into(buf, len(raw) // 80)
+        # Each header is serialized as a block with no transactions
+        for i in range(0, len(raw), 80):
+            buf += raw[i:i + 80]
+            buf.append(0)
+        return buf
 
     def __repr__(self):
-        return "msg_headers(headers=%s)" % repr(self.headers)
+        return "msg_raw_headers(headers=%d)" % (len(self.raw_headers) // 80)
 
 
 class msg_merkleblock:
@@ -1338,6 +2068,9 @@ class msg_merkleblock:
     def serialize(self):
         return self.merkleblock.serialize()
 
+    def serialize_into(self, buf):
+        return self.merkleblock.serialize_into(buf)
+
     def __repr__(self):
         return "msg_merkleblock(merkleblock=%s)" % (repr(self.merkleblock))
 
@@ -1353,18 +2086,21 @@ class msg_filterload:
         self.nFlags = nFlags
 
     def deserialize(self, f):
-        self.data = deser_string(f)
-        self.nHashFuncs = struct.unpack("<I", f.read(4))[0]
-        self.nTweak = struct.unpack("<I", f.read(4))[0]
-        self.nFlags = struct.unpack("<B", f.read(1))[0]
+        f = as_reader(f)
+        self.data = f.read_string()
+        self.nHashFuncs = f.unpack("<I")[0]
+        self.nTweak = f.unpack("<I")[0]
+        self.nFlags = f.unpack("<B")[0]
 
     def serialize(self):
-        r = b""
-        r += ser_string(self.data)
-        r += struct.pack("<I", self.nHashFuncs)
-        r += struct.pack("<I", self.nTweak)
-        r += struct.pack("<B", self.nFlags)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_string_into(buf, self.data)
+        buf += struct.pack("<I", self.nHashFuncs)
+        buf += struct.pack("<I", self.nTweak)
+        buf += struct.pack("<B", self.nFlags)
+        return buf
 
     def __repr__(self):
         return "msg_filterload(data={}, nHashFuncs={}, nTweak={}, nFlags={})".format(
@@ -1382,9 +2118,11 @@ class msg_filteradd:
         self.data = deser_string(f)
 
     def serialize(self):
-        r = b""
-        r += ser_string(self.data)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        ser_string_into(buf, self.data)
+        return buf
 
     def __repr__(self):
         return "msg_filteradd(data={})".format(self.data)
@@ -1403,6 +2141,9 @@ class msg_filterclear:
     def serialize(self):
         return b""
 
+    def serialize_into(self, buf):
+        return buf
+
     def __repr__(self):
         return "msg_filterclear()"
 
@@ -1415,12 +2156,15 @@ class msg_feefilter:
         self.feerate = feerate
 
     def deserialize(self, f):
-        self.feerate = struct.unpack("<Q", f.read(8))[0]
+        f = as_reader(f)
+        self.feerate = f.unpack("<Q")[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.feerate)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<Q", self.feerate)
+        return buf
 
     def __repr__(self):
         return "msg_feefilter(feerate=%08x)" % self.feerate
@@ -1435,14 +2179,17 @@ class msg_sendcmpct:
         self.version = 1
 
     def deserialize(self, f):
-        self.announce = struct.unpack("<?", f.read(1))[0]
-        self.version = struct.unpack("<Q", f.read(8))[0]
+        f = as_reader(f)
+        self.announce = f.unpack("<?")[0]
+        self.version = f.unpack("<Q")[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<?", self.announce)
-        r += struct.pack("<Q", self.version)
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<?", self.announce)
+        buf += struct.pack("<Q", self.version)
+        return buf
 
     def __repr__(self):
         return "msg_sendcmpct(announce=%s, version=%lu)" % (self.announce, self.version)
@@ -1460,9 +2207,11 @@ class msg_cmpctblock:
         self.header_and_shortids.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.header_and_shortids.serialize()
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        self.header_and_shortids.serialize_into(buf)
+        return buf
 
     def __repr__(self):
         return "msg_cmpctblock(HeaderAndShortIDs=%s)" % repr(self.header_and_shortids)
@@ -1480,9 +2229,11 @@ class msg_getblocktxn:
         self.block_txn_request.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.block_txn_request.serialize()
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        self.block_txn_request.serialize_into(buf)
+        return buf
 
     def __repr__(self):
         return "msg_getblocktxn(block_txn_request=%s)" % (repr(self.block_txn_request))
@@ -1499,9 +2250,11 @@ class msg_blocktxn:
         self.block_transactions.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.block_transactions.serialize()
-        return r
+        return bytes(self.serialize_into(bytearray()))
+
+    def serialize_into(self, buf):
+        self.block_transactions.serialize_into(buf)
+        return buf
 
     def __repr__(self):
         return "msg_blocktxn(block_transactions=%s)" % (repr(self.block_transactions))
@@ -1512,3 +2265,6 @@ class msg_no_witness_blocktxn(msg_blocktxn):
 
     def serialize(self):
         return self.block_transactions.serialize(with_witness=False)
+
+    def serialize_into(self, buf):
+        return self.block_transactions.serialize_into(buf, with_witness=False)
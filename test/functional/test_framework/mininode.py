@@ -12,16 +12,19 @@ found in the mini-node branch of http://github.com/jgarzik/pynode.
 P2PConnection: A low-level connection object to a node's P2P interface
 P2PInterface: A high-level interface object for communicating to a node over P2P
 P2PDataStore: A p2p interface class that keeps a store of transactions and blocks
-              and can respond correctly to getdata and getheaders messages"""
+              and can respond correctly to getdata and getheaders messages
+NetworkThread, NetworkThreadPool: threads running the network event loops that
+              service the P2P connections"""
 import asyncio
-from collections import defaultdict
-from io import BytesIO
+from collections import defaultdict, OrderedDict
+import itertools
 import logging
 import struct
 import sys
 import threading
 
 from test_framework.messages import (
+    BytesReader,
     CBlockHeader,
     MIN_VERSION_SUPPORTED,
     msg_addr,
@@ -40,6 +43,7 @@ from test_framework.messages import (
     msg_getheaders,
     msg_headers,
     msg_inv,
+    msg_lazy_block,
     msg_mempool,
     msg_merkleblock,
     msg_notfound,
@@ -54,15 +58,32 @@ from test_framework.messages import (
     msg_version,
     NODE_NETWORK,
     NODE_WITNESS,
+    repr_truncated,
     sha256,
 )
 from test_framework.util import wait_until
 
 logger = logging.getLogger("TestFramework.mininode")
 
+
+def debug_log_handled(log):
+    """Return whether a debug record logged on log would reach a handler.
+
+    Unlike log.isEnabledFor(logging.DEBUG), this also takes the levels of
+    the handlers into account."""
+    if not log.isEnabledFor(logging.DEBUG):
+        return False
+    while log is not None:
+        if any(handler.level <= logging.DEBUG for handler in log.handlers):
+            return True
+        if not log.propagate:
+            break
+        log = log.parent
+    return False
+
 MESSAGEMAP = {
     b"addr": msg_addr,
-    b"block": msg_block,
+    b"block": msg_lazy_block,
     b"blocktxn": msg_blocktxn,
     b"cmpctblock": msg_cmpctblock,
     b"feefilter": msg_feefilter,
@@ -88,6 +109,8 @@ MESSAGEMAP = {
     b"version": msg_version,
 }
 
+MAX_HEADERS_RESULTS = 2000  # Number of headers sent in one getheaders result
+
 MAGIC_BYTES = {
     "mainnet": b"\xf9\xbe\xb4\xd9",   # mainnet
     "testnet3": b"\x0b\x11\x09\x07",  # testnet3
@@ -95,6 +118,63 @@ MAGIC_BYTES = {
 }
 
 
+# magic, msgtype, payload length, checksum
+MSG_HEADER = struct.Struct("<4s12si4s")
+
+# Directions of the frames recorded by P2PConnection.capture
+CAPTURE_RECEIVE = 0
+CAPTURE_SEND = 1
+
+
+class FramedMessageCache:
+    """An LRU cache of framed P2P messages (header and payload).
+
+    Entries are keyed by the network magic, msgtype and serialized payload, so
+    sending a message whose payload hasn't changed skips computing the
+    checksum and building the frame again. The cache is limited to max_bytes
+    of payloads and frames, and can be shared by connections running on
+    different threads."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            framed = self._entries.get(key)
+            if framed is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return framed
+
+    def put(self, key, framed):
+        entry_size = len(key[2]) + len(framed)
+        if entry_size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = framed
+            self.size += entry_size
+            while self.size > self.max_bytes:
+                old_key, old_framed = self._entries.popitem(last=False)
+                self.size -= len(old_key[2]) + len(old_framed)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
 class P2PConnection(asyncio.Protocol):
     """A low-level connection object to a node's P2P interface.
 
@@ -108,33 +188,66 @@ class P2PConnection(asyncio.Protocol):
     This class contains no logic for handing the P2P message payloads. It must be
     sub-classed and the on_message() callback overridden."""
 
+    # Set to a FramedMessageCache to reuse the framing of messages that are
+    # sent more than once (eg the same block relayed to several peers). Set on
+    # the class to share one cache between all connections.
+    message_cache = None
+
+    # Set to a p2p_capture.MessageCapture to record every raw frame sent and
+    # received on the connection.
+    capture = None
+
+    # Set to False to not log the messages sent and received (see the
+    # --nop2plogging option)
+    log_messages = True
+
     def __init__(self):
         # The underlying transport of the connection.
-        # Should only call methods on this from the NetworkThread, c.f. call_soon_threadsafe
+        # Should only call methods on this from the thread running _loop, c.f. call_soon_threadsafe
         self._transport = None
+        # The network event loop this connection is serviced on
+        self._loop = None
+        # Cleared while the transport's write buffer is above its high water
+        # mark, see pause_writing()
+        self._can_write = threading.Event()
+        self._can_write.set()
 
     @property
     def is_connected(self):
         return self._transport is not None
 
-    def peer_connect(self, dstaddr, dstport, *, net):
+    def peer_connect(self, dstaddr, dstport, *, net, network_thread=None):
+        """Return a function that opens the connection.
+
+        network_thread picks the network event loop that services the
+        connection (see NetworkThread.get_event_loop()). By default the
+        connections are spread over all of them."""
         assert not self.is_connected
         self.dstaddr = dstaddr
         self.dstport = dstport
         # The initial message to send after the connection was made:
         self.on_connection_send_msg = None
-        self.recvbuf = b""
+        # Received bytes. Messages are framed in place starting at
+        # recvbuf_pos, and the consumed part is dropped after each read.
+        self.recvbuf = bytearray()
+        self.recvbuf_pos = 0
         self.magic_bytes = MAGIC_BYTES[net]
         logger.debug('Connecting to Bitcoin Node: %s:%d' % (self.dstaddr, self.dstport))
 
-        loop = NetworkThread.network_event_loop
+        loop = self._loop = NetworkThread.get_event_loop(network_thread)
         conn_gen_unsafe = loop.create_connection(lambda: self, host=self.dstaddr, port=self.dstport)
         conn_gen = lambda: loop.call_soon_threadsafe(loop.create_task, conn_gen_unsafe)
         return conn_gen
 
     def peer_disconnect(self):
         # Connection could have already been closed by other end.
-        NetworkThread.network_event_loop.call_soon_threadsafe(lambda: self._transport and self._transport.abort())
+        self._get_loop().call_soon_threadsafe(lambda: self._transport and self._transport.abort())
+
+    def _get_loop(self):
+        # A connection that was never opened isn't tied to a loop yet
+        if self._loop is None:
+            return NetworkThread.get_event_loop(0)
+        return self._loop
 
     # Connection and disconnection methods
 
@@ -143,6 +256,8 @@ class P2PConnection(asyncio.Protocol):
         assert not self._transport
         logger.debug("Connected & Listening: %s:%d" % (self.dstaddr, self.dstport))
         self._transport = transport
+        with mininode_lock:
+            mininode_lock.notify_all()
         if self.on_connection_send_msg:
             self.send_message(self.on_connection_send_msg)
             self.on_connection_send_msg = None  # Never used again
@@ -155,8 +270,21 @@ class P2PConnection(asyncio.Protocol):
         else:
             logger.debug("Closed connection to: %s:%d" % (self.dstaddr, self.dstport))
         self._transport = None
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
+        self.recvbuf_pos = 0
+        # Don't leave senders waiting for a transport that's gone
+        self._can_write.set()
         self.on_close()
+        with mininode_lock:
+            mininode_lock.notify_all()
+
+    def pause_writing(self):
+        """asyncio callback when the write buffer goes over the high water mark."""
+        self._can_write.clear()
+
+    def resume_writing(self):
+        """asyncio callback when the write buffer drains to the low water mark."""
+        self._can_write.set()
 
     # Socket read methods
 
@@ -172,35 +300,56 @@ class P2PConnection(asyncio.Protocol):
         This method reads data from the buffer in a loop. It deserializes,
         parses and verifies the P2P header, then passes the P2P payload to
         the on_message callback for processing."""
+        buf = self.recvbuf
+        # Payloads are decoded in place, without copying them out of recvbuf.
+        # All views must be released before recvbuf can be resized again.
+        view = memoryview(buf)
         try:
-            while True:
-                if len(self.recvbuf) < 4:
+            # Stop if the connection was closed (and recvbuf reset) meanwhile
+            while self.recvbuf is buf:
+                pos = self.recvbuf_pos
+                if len(buf) - pos < 4:
                     return
-                if self.recvbuf[:4] != self.magic_bytes:
-                    raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(self.recvbuf)))
-                if len(self.recvbuf) < 4 + 12 + 4 + 4:
+                if buf[pos:pos+4] != self.magic_bytes:
+                    raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(bytes(buf[pos:]))))
+                if len(buf) - pos < 4 + 12 + 4 + 4:
                     return
-                msgtype = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                checksum = self.recvbuf[4+12+4:4+12+4+4]
-                if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
+                _, msgtype, msglen, checksum = MSG_HEADER.unpack_from(buf, pos)
+                msgtype = msgtype.split(b"\x00", 1)[0]
+                if len(buf) - pos < 4 + 12 + 4 + 4 + msglen:
                     return
-                msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
-                th = sha256(msg)
-                h = sha256(th)
-                if checksum != h[:4]:
-                    raise ValueError("got bad checksum " + repr(self.recvbuf))
-                self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
-                if msgtype not in MESSAGEMAP:
-                    raise ValueError("Received unknown msgtype from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, msgtype, repr(msg)))
-                f = BytesIO(msg)
-                t = MESSAGEMAP[msgtype]()
-                t.deserialize(f)
+                msg = view[pos+4+12+4+4:pos+4+12+4+4+msglen]
+                # Release the payload view on errors too, so that the frames
+                # read before can still be dropped from recvbuf
+                try:
+                    th = sha256(msg)
+                    h = sha256(th)
+                    if checksum != h[:4]:
+                        raise ValueError("got bad checksum " + repr(bytes(buf[pos:])))
+                    self.recvbuf_pos = pos + 4 + 12 + 4 + 4 + msglen
+                    if self.capture is not None:
+                        self.capture.record(CAPTURE_RECEIVE, buf[pos:self.recvbuf_pos])
+                    if msgtype not in MESSAGEMAP:
+                        raise ValueError("Received unknown msgtype from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, msgtype, repr(bytes(msg))))
+                    t = MESSAGEMAP[msgtype]()
+                    reader = BytesReader(msg)
+                    try:
+                        t.deserialize(reader)
+                    finally:
+                        reader.buf.release()
+                finally:
+                    msg.release()
                 self._log_message("receive", t)
                 self.on_message(t)
         except Exception as e:
             logger.exception('Error reading message:', repr(e))
             raise
+        finally:
+            view.release()
+            # Drop all the messages that were read at once
+            if self.recvbuf is buf and self.recvbuf_pos:
+                del buf[:self.recvbuf_pos]
+                self.recvbuf_pos = 0
 
     def on_message(self, message):
         """Callback for processing a P2P payload. Must be overridden by derived class."""
@@ -220,6 +369,8 @@ class P2PConnection(asyncio.Protocol):
     def send_raw_message(self, raw_message_bytes):
         if not self.is_connected:
             raise IOError('Not connected')
+        if self.capture is not None:
+            self.capture.record(CAPTURE_SEND, raw_message_bytes)
 
         def maybe_write():
             if not self._transport:
@@ -227,7 +378,47 @@ class P2PConnection(asyncio.Protocol):
             if self._transport.is_closing():
                 return
             self._transport.write(raw_message_bytes)
-        NetworkThread.network_event_loop.call_soon_threadsafe(maybe_write)
+        self._get_loop().call_soon_threadsafe(maybe_write)
+
+    def send_messages(self, messages, *, batch_size=256 * 1024, timeout=60):
+        """Send a number of P2P messages over the socket.
+
+        The messages are framed on the calling thread, and handed to the
+        network thread in batches of about batch_size bytes, each written to
+        the socket at once. Before each batch, wait (up to timeout seconds)
+        while the socket's write buffer is over its high water mark. Must not
+        be called from the network thread, which would never drain it."""
+        batch = []
+        batch_bytes = 0
+        for message in messages:
+            tmsg = self.build_message(message)
+            self._log_message("send", message)
+            batch.append(tmsg)
+            batch_bytes += len(tmsg)
+            if batch_bytes >= batch_size:
+                self.send_raw_messages(batch, timeout=timeout)
+                batch = []
+                batch_bytes = 0
+        if batch:
+            self.send_raw_messages(batch, timeout=timeout)
+
+    def send_raw_messages(self, raw_messages, *, timeout=60):
+        """Send a list of serialized P2P messages with a single write."""
+        if not self._can_write.wait(timeout):
+            raise IOError('Timed out waiting for the write buffer to drain')
+        if not self.is_connected:
+            raise IOError('Not connected')
+        if self.capture is not None:
+            for raw_message_bytes in raw_messages:
+                self.capture.record(CAPTURE_SEND, raw_message_bytes)
+
+        def maybe_write():
+            if not self._transport:
+                return
+            if self._transport.is_closing():
+                return
+            self._transport.writelines(raw_messages)
+        self._get_loop().call_soon_threadsafe(maybe_write)
 
     # Class utility methods
 
@@ -235,23 +426,32 @@ class P2PConnection(asyncio.Protocol):
         """Build a serialized P2P message"""
         msgtype = message.msgtype
         data = message.serialize()
-        tmsg = self.magic_bytes
-        tmsg += msgtype
-        tmsg += b"\x00" * (12 - len(msgtype))
-        tmsg += struct.pack("<I", len(data))
+        cache = self.message_cache
+        if cache is None:
+            return self._frame_message(msgtype, data)
+        key = (self.magic_bytes, msgtype, bytes(data))
+        tmsg = cache.get(key)
+        if tmsg is None:
+            tmsg = self._frame_message(msgtype, data)
+            cache.put(key, tmsg)
+        return tmsg
+
+    def _frame_message(self, msgtype, data):
         th = sha256(data)
         h = sha256(th)
-        tmsg += h[:4]
-        tmsg += data
-        return tmsg
+        return b"".join([self.magic_bytes, msgtype, b"\x00" * (12 - len(msgtype)),
+                         struct.pack("<I", len(data)), h[:4], data])
 
     def _log_message(self, direction, msg):
         """Logs a message being sent or received over the connection."""
+        # Don't build the message repr if it would be thrown away
+        if not self.log_messages or not debug_log_handled(logger):
+            return
         if direction == "send":
             log_message = "Send message to "
         elif direction == "receive":
             log_message = "Received message from "
-        log_message += "%s:%d: %s" % (self.dstaddr, self.dstport, repr(msg)[:500])
+        log_message += "%s:%d: %s" % (self.dstaddr, self.dstport, repr_truncated(msg, 500))
         if len(log_message) > 500:
             log_message += "... (msg truncated)"
         logger.debug(log_message)
@@ -311,6 +511,8 @@ class P2PInterface(P2PConnection):
             except:
                 print("ERROR delivering %s (%s)" % (repr(message), sys.exc_info()[0]))
                 raise
+            finally:
+                mininode_lock.notify_all()
 
     # Callback methods. Can be overridden by subclasses in individual test
     # cases to provide custom message handling behaviour.
@@ -476,31 +678,80 @@ class P2PInterface(P2PConnection):
 # P2PConnection acquires this lock whenever delivering a message to a P2PInterface.
 # This lock should be acquired in the thread running the test logic to synchronize
 # access to any data shared with the P2PInterface or P2PConnection.
-mininode_lock = threading.RLock()
+#
+# It is a condition variable (around a reentrant lock) that is notified after
+# every message delivered to a P2PInterface and whenever a connection opens or
+# closes, so wait_until(..., lock=mininode_lock) wakes up right away instead of
+# polling.
+mininode_lock = threading.Condition(threading.RLock())
 
 
 class NetworkThread(threading.Thread):
-    network_event_loop = None
+    """A thread running one network event loop.
 
-    def __init__(self):
-        super().__init__(name="NetworkThread")
-        # There is only one event loop and no more than one thread must be created
-        assert not self.network_event_loop
-
-        NetworkThread.network_event_loop = asyncio.new_event_loop()
+    Usually there is a single NetworkThread. A NetworkThreadPool starts
+    several, and P2P connections are then spread over their event loops."""
+    # The first network event loop
+    network_event_loop = None
+    # All network event loops, in the order their threads were created
+    network_event_loops = []
+    # Source of the round-robin assignment of connections to event loops
+    _next_event_loop = itertools.count()
+
+    def __init__(self, index=0):
+        super().__init__(name="NetworkThread" if index == 0 else "NetworkThread-%d" % index)
+        # Only one thread must be created for each event loop
+        assert len(self.network_event_loops) == index
+
+        self.event_loop = asyncio.new_event_loop()
+        if index == 0:
+            NetworkThread.network_event_loop = self.event_loop
+        NetworkThread.network_event_loops.append(self.event_loop)
+
+    @classmethod
+    def get_event_loop(cls, network_thread=None):
+        """Return the event loop a new connection should use.
+
+        This is the loop of network thread number network_thread (modulo the
+        number of threads) if given, or else the next one in round-robin order."""
+        if network_thread is None:
+            network_thread = next(cls._next_event_loop)
+        return cls.network_event_loops[network_thread % len(cls.network_event_loops)]
 
     def run(self):
         """Start the network thread."""
-        self.network_event_loop.run_forever()
+        self.event_loop.run_forever()
 
     def close(self, timeout=10):
         """Close the connections and network event loop."""
-        self.network_event_loop.call_soon_threadsafe(self.network_event_loop.stop)
-        wait_until(lambda: not self.network_event_loop.is_running(), timeout=timeout)
-        self.network_event_loop.close()
+        self.event_loop.call_soon_threadsafe(self.event_loop.stop)
+        wait_until(lambda: not self.event_loop.is_running(), timeout=timeout)
+        self.event_loop.close()
         self.join(timeout)
         # Safe to remove event loop.
-        NetworkThread.network_event_loop = None
+        NetworkThread.network_event_loops.remove(self.event_loop)
+        if NetworkThread.network_event_loop is self.event_loop:
+            NetworkThread.network_event_loop = None
+
+
+class NetworkThreadPool:
+    """Several network threads, each running its own event loop.
+
+    Decoding and dispatching received messages is spread over the threads.
+    Callbacks into P2PInterface still hold mininode_lock, so they don't run
+    concurrently with each other or with the test logic."""
+
+    def __init__(self, num_threads=1):
+        assert num_threads >= 1
+        self.threads = [NetworkThread(i) for i in range(num_threads)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def close(self, timeout=10):
+        for thread in reversed(self.threads):
+            thread.close(timeout)
 
 class P2PDataStore(P2PInterface):
     """A P2P data store class.
@@ -512,6 +763,11 @@ class P2PDataStore(P2PInterface):
         # store of blocks. key is block hash, value is a CBlock object
         self.block_store = {}
         self.last_block_hash = ''
+        # the chain of stored blocks ending at the tip. active_chain is a list of
+        # block hashes indexed by height, active_chain_index maps each of those
+        # hashes back to its height
+        self.active_chain = []
+        self.active_chain_index = {}
         # store of txs. key is txid, value is a CTransaction object
         self.tx_store = {}
         self.getdata_requests = []
@@ -528,36 +784,30 @@ class P2PDataStore(P2PInterface):
                 logger.debug('getdata message type {} received.'.format(hex(inv.type)))
 
     def on_getheaders(self, message):
-        """Search back through our block store for the locator, and reply with a headers message if found."""
+        """Find the fork point with our chain from the locator, and reply with a headers message for the blocks after it."""
 
         locator, hash_stop = message.locator, message.hashstop
 
         # Assume that the most recent block added is the tip
-        if not self.block_store:
+        if not self.active_chain:
             return
 
-        headers_list = [self.block_store[self.last_block_hash]]
-        maxheaders = 2000
-        while headers_list[-1].sha256 not in locator.vHave:
-            # Walk back through the block store, adding headers to headers_list
-            # as we go.
-            prev_block_hash = headers_list[-1].hashPrevBlock
-            if prev_block_hash in self.block_store:
-                prev_block_header = CBlockHeader(self.block_store[prev_block_hash])
-                headers_list.append(prev_block_header)
-                if prev_block_header.sha256 == hash_stop:
-                    # if this is the hashstop header, stop here
-                    break
-            else:
-                logger.debug('block hash {} not found in block store'.format(hex(prev_block_hash)))
+        # Start after the first locator entry on our chain, or from the oldest
+        # stored block if there is none
+        start = 0
+        for block_hash in locator.vHave:
+            height = self.active_chain_index.get(block_hash)
+            if height is not None:
+                start = height + 1
                 break
 
-        # Truncate the list if there are too many headers
-        headers_list = headers_list[:-maxheaders - 1:-1]
-        response = msg_headers(headers_list)
+        end = min(start + MAX_HEADERS_RESULTS, len(self.active_chain))
+        stop_height = self.active_chain_index.get(hash_stop)
+        if stop_height is not None and start <= stop_height < end:
+            end = stop_height + 1
 
-        if response is not None:
-            self.send_message(response)
+        headers_list = [CBlockHeader(self.block_store[block_hash]) for block_hash in self.active_chain[start:end]]
+        self.send_message(msg_headers(headers_list))
 
     def send_blocks_and_test(self, blocks, node, *, success=True, force_send=False, reject_reason=None, expect_disconnect=False, timeout=60):
         """Send blocks to test node and test whether the tip advances.
@@ -573,14 +823,12 @@ class P2PDataStore(P2PInterface):
 
         with mininode_lock:
             for block in blocks:
-                self.block_store[block.sha256] = block
-                self.last_block_hash = block.sha256
+                self.store_block(block)
 
         reject_reason = [reject_reason] if reject_reason else []
         with node.assert_debug_log(expected_msgs=reject_reason):
             if force_send:
-                for b in blocks:
-                    self.send_message(msg_block(block=b))
+                self.send_messages(msg_block(block=b) for b in blocks)
             else:
                 self.send_message(msg_headers([CBlockHeader(block) for block in blocks]))
                 wait_until(lambda: blocks[-1].sha256 in self.getdata_requests, timeout=timeout, lock=mininode_lock)
@@ -595,6 +843,26 @@ class P2PDataStore(P2PInterface):
             else:
                 assert node.getbestblockhash() != blocks[-1].hash
 
+    def store_block(self, block):
+        """Add a block to the block store and make it the tip."""
+        self.block_store[block.sha256] = block
+        self.last_block_hash = block.sha256
+
+        # Walk back from the new tip to where it joins the active chain, and
+        # replace everything above that point
+        new_hashes = []
+        block_hash = block.sha256
+        while block_hash not in self.active_chain_index and block_hash in self.block_store:
+            new_hashes.append(block_hash)
+            block_hash = self.block_store[block_hash].hashPrevBlock
+        fork_height = self.active_chain_index.get(block_hash, -1)
+        for stale_hash in self.active_chain[fork_height + 1:]:
+            del self.active_chain_index[stale_hash]
+        del self.active_chain[fork_height + 1:]
+        for block_hash in reversed(new_hashes):
+            self.active_chain_index[block_hash] = len(self.active_chain)
+            self.active_chain.append(block_hash)
+
     def send_txs_and_test(self, txs, node, *, success=True, expect_disconnect=False, reject_reason=None):
         """Send txs to test node and test whether they're accepted to the mempool.
 
@@ -610,8 +878,7 @@ class P2PDataStore(P2PInterface):
 
         reject_reason = [reject_reason] if reject_reason else []
         with node.assert_debug_log(expected_msgs=reject_reason):
-            for tx in txs:
-                self.send_message(msg_tx(tx))
+            self.send_messages(msg_tx(tx) for tx in txs)
 
             if expect_disconnect:
                 self.wait_for_disconnect()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Capture the raw P2P frames of a connection to a file, and replay them.
+
+MessageCapture: writes the frames sent and received on a P2PConnection to a
+                capture file. Set it as the connection's capture attribute.
+read_capture: iterates over the records of a capture file
+decode_capture: iterates over the records of a capture file, with the frames
+                deserialized into messages
+replay_capture: sends the frames of a capture file over a connection, at the
+                original speed or faster
+
+A capture file starts with CAPTURE_FILE_MAGIC, followed by one record per
+frame: a RECORD_HEADER (direction, timestamp, frame length) and the frame
+itself (message header and payload, exactly as on the wire)."""
+from collections import deque
+import struct
+import threading
+import time
+
+from test_framework.messages import BytesReader
+from test_framework.mininode import (
+    CAPTURE_SEND,
+    MESSAGEMAP,
+    MSG_HEADER,
+)
+
+CAPTURE_FILE_MAGIC = b"P2PCAP\x00\x01"
+
+# direction, time.time() timestamp, frame length
+RECORD_HEADER = struct.Struct("<BdI")
+
+
+class MessageCapture:
+    """Record P2P frames to a capture file.
+
+    record() is called on the network thread, and only queues the frame. A
+    background thread writes the queued frames to the file every
+    flush_interval seconds through a large buffer, so capturing adds little
+    to the time spent on the event loop."""
+
+    def __init__(self, path, *, flush_interval=0.1, buffer_size=1024 * 1024):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.frames = 0
+        self._file = open(path, "wb", buffering=buffer_size)
+        self._file.write(CAPTURE_FILE_MAGIC)
+        # deque.append() and popleft() are thread safe, so no lock is needed
+        self._queue = deque()
+        self._closing = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, name="MessageCapture", daemon=True)
+        self._writer.start()
+
+    def record(self, direction, frame):
+        """Queue a frame to be written. frame must not be modified afterwards."""
+        self._queue.append((direction, time.time(), frame))
+
+    def _write_loop(self):
+        while not self._closing.wait(self.flush_interval):
+            self._write_queued()
+        self._write_queued()
+
+    def _write_queued(self):
+        queue = self._queue
+        write = self._file.write
+        while queue:
+            direction, timestamp, frame = queue.popleft()
+            write(RECORD_HEADER.pack(direction, timestamp, len(frame)))
+            write(frame)
+            self.frames += 1
+
+    def close(self):
+        """Write all queued frames and close the file."""
+        if self._writer.is_alive():
+            self._closing.set()
+            self._writer.join()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_capture(path):
+    """Yield (direction, timestamp, frame) for each frame in a capture file."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(CAPTURE_FILE_MAGIC)] != CAPTURE_FILE_MAGIC:
+        raise ValueError("{} is not a capture file".format(path))
+    pos = len(CAPTURE_FILE_MAGIC)
+    while pos < len(data):
+        if len(data) - pos < RECORD_HEADER.size:
+            raise ValueError("truncated record header at offset {}".format(pos))
+        direction, timestamp, length = RECORD_HEADER.unpack_from(data, pos)
+        pos += RECORD_HEADER.size
+        if len(data) - pos < length:
+            raise ValueError("truncated frame at offset {}".format(pos))
+        yield direction, timestamp, data[pos:pos + length]
+        pos += length
+
+
+def decode_frame(frame):
+    """Deserialize the message in a raw frame. The checksum isn't verified."""
+    _, msgtype, msglen, _ = MSG_HEADER.unpack_from(frame)
+    msgtype = msgtype.split(b"\x00", 1)[0]
+    if msgtype not in MESSAGEMAP:
+        raise ValueError("unknown msgtype '{}'".format(msgtype))
+    msg = MESSAGEMAP[msgtype]()
+    msg.deserialize(BytesReader(frame[MSG_HEADER.size:MSG_HEADER.size + msglen]))
+    return msg
+
+
+def decode_capture(path):
+    """Yield (direction, timestamp, message) for each frame in a capture file."""
+    for direction, timestamp, frame in read_capture(path):
+        yield direction, timestamp, decode_frame(frame)
+
+
+def replay_capture(path, conn, *, direction=CAPTURE_SEND, speed=1.0):
+    """Send the frames of a capture file that went in the given direction over conn.
+
+    The frames are sent with the same spacing as when they were captured,
+    divided by speed. If speed is None they are sent as fast as possible.
+    The frames are sent unmodified, so the capture must be for the same
+    network, and a capture that starts with a version handshake should be
+    replayed over a connection made with send_version=False.
+
+    Returns the number of frames sent."""
+    sent = 0
+    start = first = None
+    for frame_direction, timestamp, frame in read_capture(path):
+        if frame_direction != direction:
+            continue
+        if speed is not None:
+            if first is None:
+                start, first = time.time(), timestamp
+            delay = (timestamp - first) / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        conn.send_raw_message(frame)
+        sent += 1
+    return sent
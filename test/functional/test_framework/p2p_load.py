@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Generate synthetic P2P load against a node.
+
+LoadPeer: a P2PInterface that sends a weighted mix of messages to the node at
+          a target rate, and measures the round trip time of its pings
+LoadGenerator: opens a number of LoadPeer connections to a node, runs them
+               for a while and collects their statistics into a LoadStats
+
+Messages in the mix are serialized and framed once when the load starts,
+so sending them only costs a transport write on the network thread. Pings
+are the exception: each one gets a new nonce so that its pong can be matched
+to it."""
+import itertools
+import random
+import time
+
+from test_framework.messages import (
+    CInv,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    MSG_BLOCK,
+    MSG_TX,
+    msg_getdata,
+    msg_headers,
+    msg_inv,
+    msg_ping,
+    msg_tx,
+)
+from test_framework.mininode import (
+    MESSAGEMAP,
+    mininode_lock,
+    P2PInterface,
+)
+from test_framework.util import wait_until
+
+
+def default_message_mix(seed=0):
+    """Return a mix of (message, weight) pairs that a node handles without
+    disconnecting the sender.
+
+    The inv and getdata messages are for random hashes the node doesn't
+    know, the tx spends an unknown output (so it ends up as an orphan) and the
+    headers message is empty."""
+    rng = random.Random(seed)
+    tx = CTransaction()
+    tx.vin.append(CTxIn(COutPoint(rng.getrandbits(256), 0)))
+    tx.vout.append(CTxOut(1000, b"\x51"))
+    return [
+        (msg_inv([CInv(MSG_TX, rng.getrandbits(256)) for _ in range(16)]), 4),
+        (msg_getdata([CInv(MSG_BLOCK, rng.getrandbits(256))]), 2),
+        (msg_tx(tx), 1),
+        (msg_headers([]), 1),
+        (msg_ping(), 1),
+    ]
+
+
+def percentile(values, p):
+    """Return the p-th percentile (0-100) of values, by the nearest rank."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(p / 100 * len(values))), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+class LoadPeer(P2PInterface):
+    """A P2P connection that sends a message mix at a target rate.
+
+    mix is a list of (message, weight) pairs. The message types must be known
+    to MESSAGEMAP. rate is the number of messages per second. The messages are
+    sent in bursts every interval seconds, and a burst is skipped while more
+    than max_buffered bytes are waiting to be written to the socket."""
+
+    def __init__(self, mix, rate, *, seed=0, interval=0.01, max_buffered=1024 * 1024):
+        super().__init__()
+        for message, weight in mix:
+            assert message.msgtype in MESSAGEMAP, "unknown msgtype {}".format(message.msgtype)
+            assert weight > 0
+        self.mix = mix
+        self.rate = rate
+        self.interval = interval
+        self.max_buffered = max_buffered
+        self.rng = random.Random(seed)
+
+        # The framed messages of the mix (None for pings, which are framed
+        # when sent), their cumulative weights and the next ping nonce. Set
+        # by start_load().
+        self._frames = []
+        self._weights = []
+        self._next_nonce = 0
+
+        self.running = False
+        self.load_start = None
+        self.load_end = None
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.bursts_skipped = 0
+        self.disconnected = False
+        # nonce -> time the ping was sent, for pings that weren't answered yet
+        self.pings_in_flight = {}
+        self.ping_times = []
+
+    def start_load(self):
+        """Start sending the mix. Can be called from any thread."""
+        self._frames = [None if message.msgtype == b"ping" else self.build_message(message) for message, _ in self.mix]
+        self._weights = list(itertools.accumulate(weight for _, weight in self.mix))
+        self._next_nonce = self.rng.getrandbits(32) << 32
+        self._loop.call_soon_threadsafe(self._start)
+
+    def stop_load(self):
+        """Stop sending the mix. Can be called from any thread."""
+        self._loop.call_soon_threadsafe(self._stop)
+
+    def _start(self):
+        self.running = True
+        self.load_start = time.perf_counter()
+        self._send_burst()
+
+    def _stop(self):
+        if self.running:
+            self.running = False
+            self.load_end = time.perf_counter()
+
+    def _send_burst(self):
+        if not self.running:
+            return
+        transport = self._transport
+        if transport is None or transport.is_closing():
+            self._stop()
+            return
+        if transport.get_write_buffer_size() > self.max_buffered:
+            self.bursts_skipped += 1
+        else:
+            # Catch up with the target rate, so that late bursts don't lower it
+            due = int((time.perf_counter() - self.load_start) * self.rate) - self.messages_sent
+            if due > 0:
+                frames = []
+                for index in self.rng.choices(range(len(self._frames)), cum_weights=self._weights, k=due):
+                    frame = self._frames[index]
+                    if frame is None:
+                        frame = self._build_ping()
+                    frames.append(frame)
+                transport.writelines(frames)
+                self.messages_sent += due
+                self.bytes_sent += sum(map(len, frames))
+        self._loop.call_later(self.interval, self._send_burst)
+
+    def _build_ping(self):
+        nonce = self._next_nonce
+        self._next_nonce += 1
+        self.pings_in_flight[nonce] = time.perf_counter()
+        return self.build_message(msg_ping(nonce))
+
+    def _log_message(self, direction, msg):
+        # The bursts are written to the transport directly and aren't logged.
+        # Don't log the replies either, there are too many of them.
+        pass
+
+    def on_pong(self, message):
+        sent = self.pings_in_flight.pop(message.nonce, None)
+        if sent is not None:
+            self.ping_times.append(time.perf_counter() - sent)
+
+    def on_close(self):
+        self.disconnected = self.running
+        self._stop()
+
+
+class LoadStats:
+    """Aggregate statistics of a load generator run."""
+
+    def __init__(self, peers):
+        self.connections = len(peers)
+        self.messages_sent = sum(peer.messages_sent for peer in peers)
+        self.bytes_sent = sum(peer.bytes_sent for peer in peers)
+        self.bursts_skipped = sum(peer.bursts_skipped for peer in peers)
+        self.disconnects = sum(peer.disconnected for peer in peers)
+        self.pings_unanswered = sum(len(peer.pings_in_flight) for peer in peers)
+        self.ping_times = sorted(t for peer in peers for t in peer.ping_times)
+        durations = [peer.load_end - peer.load_start for peer in peers if peer.load_start is not None and peer.load_end is not None]
+        self.duration = max(durations) if durations else 0
+
+    @property
+    def send_rate(self):
+        """Messages sent per second, over all connections."""
+        return self.messages_sent / self.duration if self.duration else 0
+
+    def ping_percentile(self, p):
+        """The p-th percentile of the ping round trip times, in seconds."""
+        return percentile(self.ping_times, p)
+
+    def __repr__(self):
+        line = "%d connections: %d msgs in %.2fs (%.0f msgs/s, %.0f kB/s), %d disconnects" % (
+            self.connections, self.messages_sent, self.duration, self.send_rate,
+            self.bytes_sent / 1000 / self.duration if self.duration else 0, self.disconnects)
+        if self.ping_times:
+            line += ", ping p50/p90/p99 %.1f/%.1f/%.1f ms" % tuple(1000 * self.ping_percentile(p) for p in (50, 90, 99))
+        return line
+
+
+class LoadGenerator:
+    """Open connections to a node and send it a message mix from all of them.
+
+    rate is the target number of messages per second of each connection. Each
+    connection gets its own random seed derived from seed, so runs are
+    repeatable."""
+
+    def __init__(self, node, *, connections=8, rate=100, mix=None, seed=0, peer_class=LoadPeer):
+        self.node = node
+        self.peers = []
+        for i in range(connections):
+            peer_mix = mix if mix is not None else default_message_mix(seed + i)
+            self.peers.append(peer_class(peer_mix, rate, seed=seed + i))
+
+    def connect(self):
+        for peer in self.peers:
+            self.node.add_p2p_connection(peer)
+
+    def run(self, duration, *, timeout=60):
+        """Send load for duration seconds, then wait for the outstanding pongs.
+
+        Returns a LoadStats."""
+        for peer in self.peers:
+            peer.start_load()
+        time.sleep(duration)
+        for peer in self.peers:
+            peer.stop_load()
+        wait_until(lambda: all(not peer.running for peer in self.peers), timeout=timeout, lock=mininode_lock)
+        # Pings are answered in order, so one more round trip flushes them
+        for peer in self.peers:
+            if peer.is_connected:
+                peer.sync_with_ping(timeout=timeout)
+        return LoadStats(self.peers)
@@ -5,8 +5,16 @@
 """Specialized SipHash-2-4 implementations.
 
 This implements SipHash-2-4 for 256-bit integers.
+
+siphash256_batch() hashes many integers with the same key at once. It uses
+NumPy, with one array lane per input, when it is installed.
 """
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def rotl64(n, b):
     return n >> (64 - b) | (n & ((1 << (64 - b)) - 1)) << b
 
@@ -61,3 +69,77 @@ def siphash256(k0, k1, h):
     v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
     v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
     return v0 ^ v1 ^ v2 ^ v3
+
+def _siphash256_batch_python(k0, k1, hs):
+    # siphash256() with the rounds inlined to save the function calls
+    mask = (1 << 64) - 1
+    init = (0x736f6d6570736575 ^ k0, 0x646f72616e646f6d ^ k1,
+            0x6c7967656e657261 ^ k0, 0x7465646279746573 ^ k1)
+    result = []
+    for h in hs:
+        v0, v1, v2, v3 = init
+        # (message word, value xored into v2, number of rounds); the last entry is the finalization
+        for m, x, rounds in ((h & mask, 0, 2), ((h >> 64) & mask, 0, 2), ((h >> 128) & mask, 0, 2),
+                             ((h >> 192) & mask, 0, 2), (0x2000000000000000, 0, 2), (0, 0xFF, 4)):
+            v3 ^= m
+            v2 ^= x
+            for _ in range(rounds):
+                v0 = (v0 + v1) & mask
+                v1 = ((v1 << 13) & mask | v1 >> 51) ^ v0
+                v0 = (v0 << 32) & mask | v0 >> 32
+                v2 = (v2 + v3) & mask
+                v3 = ((v3 << 16) & mask | v3 >> 48) ^ v2
+                v0 = (v0 + v3) & mask
+                v3 = ((v3 << 21) & mask | v3 >> 43) ^ v0
+                v2 = (v2 + v1) & mask
+                v1 = ((v1 << 17) & mask | v1 >> 47) ^ v2
+                v2 = (v2 << 32) & mask | v2 >> 32
+            v0 ^= m
+        result.append(v0 ^ v1 ^ v2 ^ v3)
+    return result
+
+def _siphash256_batch_numpy(k0, k1, hs):
+    u64 = numpy.uint64
+    mask = (1 << 256) - 1
+    # Column i holds the i-th 64-bit word of every input
+    words = numpy.frombuffer(b"".join([(h & mask).to_bytes(32, 'little') for h in hs]), dtype='<u8').reshape(-1, 4).T
+    n = words.shape[1]
+    v0 = numpy.full(n, 0x736f6d6570736575 ^ k0, dtype=u64)
+    v1 = numpy.full(n, 0x646f72616e646f6d ^ k1, dtype=u64)
+    v2 = numpy.full(n, 0x6c7967656e657261 ^ k0, dtype=u64)
+    v3 = numpy.full(n, 0x7465646279746573 ^ k1, dtype=u64)
+
+    def rotl(x, b):
+        return (x << u64(b)) | (x >> u64(64 - b))
+
+    def rounds(v0, v1, v2, v3, count):
+        for _ in range(count):
+            v0 += v1
+            v1 = rotl(v1, 13) ^ v0
+            v0 = rotl(v0, 32)
+            v2 += v3
+            v3 = rotl(v3, 16) ^ v2
+            v0 += v3
+            v3 = rotl(v3, 21) ^ v0
+            v2 += v1
+            v1 = rotl(v1, 17) ^ v2
+            v2 = rotl(v2, 32)
+        return v0, v1, v2, v3
+
+    for m in (words[0], words[1], words[2], words[3], u64(0x2000000000000000)):
+        v3 ^= m
+        v0, v1, v2, v3 = rounds(v0, v1, v2, v3, 2)
+        v0 ^= m
+    v2 ^= u64(0xFF)
+    v0, v1, v2, v3 = rounds(v0, v1, v2, v3, 4)
+    return (v0 ^ v1 ^ v2 ^ v3).tolist()
+
+def siphash256_batch(k0, k1, hs, use_numpy=None):
+    """Return [siphash256(k0, k1, h) for h in hs].
+
+    use_numpy selects the implementation; by default NumPy is used if available."""
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    if use_numpy and hs:
+        return _siphash256_batch_numpy(k0, k1, hs)
+    return _siphash256_batch_python(k0, k1, hs)
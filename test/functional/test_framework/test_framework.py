@@ -20,7 +20,7 @@ import time
 from .authproxy import JSONRPCException
 from . import coverage
 from .test_node import TestNode
-from .mininode import NetworkThread
+from .mininode import NetworkThreadPool, P2PConnection
 from .util import (
     MAX_NODES,
     PortSeed,
@@ -96,6 +96,8 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         self.setup_clean_chain = False
         self.nodes = []
         self.network_thread = None
+        # Number of network event loops (and threads) servicing P2P connections
+        self.num_network_threads = 1
         self.rpc_timeout = 60  # Wait for up to 60 seconds for the RPC server to respond
         self.supports_cli = True
         self.bind_to_localhost_only = True
@@ -148,6 +150,8 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
                             help="log events at this level and higher to the console. Can be set to DEBUG, INFO, WARNING, ERROR or CRITICAL. Passing --loglevel DEBUG will output all logs to console. Note that logs at all levels are always written to the test_framework.log file in the temporary test directory.")
         parser.add_argument("--tracerpc", dest="trace_rpc", default=False, action="store_true",
                             help="Print out all RPC calls as they are made")
+        parser.add_argument("--nop2plogging", dest="nop2plogging", default=False, action="store_true",
+                            help="Don't log the P2P messages sent and received by the test framework")
         parser.add_argument("--portseed", dest="port_seed", default=os.getpid(), type=int,
                             help="The seed to use for assigning port numbers (default: current process id)")
         parser.add_argument("--coveragedir", dest="coveragedir",
@@ -216,7 +220,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         self.log.debug("PRNG seed is: {}".format(seed))
 
         self.log.debug('Setting up network thread')
-        self.network_thread = NetworkThread()
+        self.network_thread = NetworkThreadPool(self.num_network_threads)
         self.network_thread.start()
 
         if self.options.usecli:
@@ -528,6 +532,9 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         self.log.addHandler(fh)
         self.log.addHandler(ch)
 
+        if self.options.nop2plogging:
+            P2PConnection.log_messages = False
+
         if self.options.trace_rpc:
             rpc_logger = logging.getLogger("BitcoinRPC")
             rpc_logger.setLevel(logging.DEBUG)
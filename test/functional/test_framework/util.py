@@ -6,6 +6,7 @@
 
 from base64 import b64encode
 from binascii import unhexlify
+from concurrent.futures import ProcessPoolExecutor
 from decimal import Decimal, ROUND_DOWN
 from subprocess import CalledProcessError
 import inspect
@@ -14,6 +15,7 @@ import logging
 import os
 import random
 import re
+import threading
 import time
 
 from . import coverage
@@ -215,7 +217,17 @@ def wait_until(predicate, *, attempts=float('inf'), timeout=float('inf'), lock=N
     time_end = time.time() + timeout
 
     while attempt < attempts and time.time() < time_end:
-        if lock:
+        if isinstance(lock, threading.Condition):
+            # Re-check as soon as the condition is notified (eg when a p2p
+            # message is delivered), but at least every 50ms for changes that
+            # aren't notified. Every check counts as an attempt.
+            with lock:
+                if predicate():
+                    return
+                attempt += 1
+                lock.wait(min(0.05, max(0, time_end - time.time())))
+            continue
+        elif lock:
             with lock:
                 if predicate():
                     return
@@ -234,6 +246,20 @@ def wait_until(predicate, *, attempts=float('inf'), timeout=float('inf'), lock=N
         raise AssertionError("Predicate {} not true after {} seconds".format(predicate_source, timeout))
     raise RuntimeError('Unreachable')
 
+def map_chunks(fn, items, processes=None, chunk_size=None):
+    """Split items (a list or range) into chunks and return [fn(chunk) for chunk in chunks].
+
+    If processes is set, the chunks are processed by a pool of that many
+    processes, so fn and the chunks must be picklable. chunk_size defaults to
+    enough for four chunks per process."""
+    if chunk_size is None:
+        chunk_size = max(-(-len(items) // ((processes or 1) * 4)), 1)
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    if not processes:
+        return [fn(chunk) for chunk in chunks]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(fn, chunks))
+
 # RPC/P2P connection constants and functions
 ############################################
 
@@ -4,18 +4,24 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 """Useful util functions for testing the wallet"""
 from collections import namedtuple
+import functools
+import random
 
 from test_framework.address import (
+    keyhash_to_p2pkh,
     key_to_p2pkh,
     key_to_p2sh_p2wpkh,
     key_to_p2wpkh,
+    scripthash_to_p2sh,
     script_to_p2sh,
     script_to_p2sh_p2wsh,
     script_to_p2wsh,
 )
 from test_framework.key import (
     bytes_to_wif,
+    derive_keys,
     ECKey,
+    get_pubkeys,
 )
 from test_framework.script import (
     CScript,
@@ -31,7 +37,8 @@ from test_framework.script import (
     hash160,
     sha256,
 )
-from test_framework.util import hex_str_to_bytes
+from test_framework.segwit_addr import bech32_encode, convertbits
+from test_framework.util import hex_str_to_bytes, map_chunks
 
 Key = namedtuple('Key', ['privkey',
                          'pubkey',
@@ -59,25 +66,28 @@ def get_key(node):
     Returns a named tuple of privkey, pubkey and all address and scripts."""
     addr = node.getnewaddress()
     pubkey = node.getaddressinfo(addr)['pubkey']
-    pkh = hash160(hex_str_to_bytes(pubkey))
-    return Key(privkey=node.dumpprivkey(addr),
-               pubkey=pubkey,
-               p2pkh_script=CScript([OP_DUP, OP_HASH160, pkh, OP_EQUALVERIFY, OP_CHECKSIG]).hex(),
-               p2pkh_addr=key_to_p2pkh(pubkey),
-               p2wpkh_script=CScript([OP_0, pkh]).hex(),
-               p2wpkh_addr=key_to_p2wpkh(pubkey),
-               p2sh_p2wpkh_script=CScript([OP_HASH160, hash160(CScript([OP_0, pkh])), OP_EQUAL]).hex(),
-               p2sh_p2wpkh_redeem_script=CScript([OP_0, pkh]).hex(),
-               p2sh_p2wpkh_addr=key_to_p2sh_p2wpkh(pubkey))
+    return _key_from_pubkey(node.dumpprivkey(addr), pubkey)
 
 def get_generate_key():
     """Generate a fresh key
 
     Returns a named tuple of privkey, pubkey and all address and scripts."""
-    eckey = ECKey()
-    eckey.generate()
-    privkey = bytes_to_wif(eckey.get_bytes())
-    pubkey = eckey.get_pubkey().get_bytes().hex()
+    return get_generate_keys(1)[0]
+
+def get_generate_keys(n):
+    """Generate n fresh keys
+
+    Returns a list of named tuples of privkey, pubkey and all address and
+    scripts. The public keys are computed together (see key.get_pubkeys())."""
+    eckeys = []
+    for _ in range(n):
+        eckey = ECKey()
+        eckey.generate()
+        eckeys.append(eckey)
+    return [_key_from_pubkey(bytes_to_wif(eckey.get_bytes()), pubkey.get_bytes().hex())
+            for eckey, pubkey in zip(eckeys, get_pubkeys(eckeys))]
+
+def _key_from_pubkey(privkey, pubkey):
     pkh = hash160(hex_str_to_bytes(pubkey))
     return Key(privkey=privkey,
                pubkey=pubkey,
@@ -89,6 +99,73 @@ def get_generate_key():
                p2sh_p2wpkh_redeem_script=CScript([OP_0, pkh]).hex(),
                p2sh_p2wpkh_addr=key_to_p2sh_p2wpkh(pubkey))
 
+class KeyPairs:
+    """Key pairs and their addresses, as returned by generate_key_pairs().
+
+    The private keys and compressed public keys are stored back to back in
+    two bytes objects, and the legacy, p2sh-segwit and bech32 addresses in
+    lists, so that 100,000s of keys take little memory and are cheap to send
+    between processes. get_key(i) returns key i as a Key named tuple."""
+
+    def __init__(self, seed, secrets, pubkeys, p2pkh_addrs, p2sh_p2wpkh_addrs, p2wpkh_addrs):
+        self.seed = seed
+        self.secrets = secrets
+        self.pubkeys = pubkeys
+        self.p2pkh_addrs = p2pkh_addrs
+        self.p2sh_p2wpkh_addrs = p2sh_p2wpkh_addrs
+        self.p2wpkh_addrs = p2wpkh_addrs
+
+    def __len__(self):
+        return len(self.p2pkh_addrs)
+
+    def get_secret(self, i):
+        return self.secrets[32 * i:32 * (i + 1)]
+
+    def get_pubkey(self, i):
+        return self.pubkeys[33 * i:33 * (i + 1)]
+
+    def get_eckey(self, i):
+        eckey = ECKey()
+        eckey.set(self.get_secret(i), True)
+        return eckey
+
+    def get_key(self, i):
+        return _key_from_pubkey(bytes_to_wif(self.get_secret(i)), self.get_pubkey(i).hex())
+
+def _generate_key_pair_chunk(seed, indices):
+    eckeys = derive_keys(seed, indices.start, indices.stop)
+    pubkeys = [pubkey.get_bytes() for pubkey in get_pubkeys(eckeys)]
+    p2pkh_addrs = []
+    p2sh_p2wpkh_addrs = []
+    p2wpkh_addrs = []
+    for pubkey in pubkeys:
+        # Hash each public key once for all three addresses
+        pkh = hash160(pubkey)
+        p2pkh_addrs.append(keyhash_to_p2pkh(pkh))
+        p2sh_p2wpkh_addrs.append(scripthash_to_p2sh(hash160(b'\x00\x14' + pkh)))
+        # program_to_witness() decodes each address again to check it
+        p2wpkh_addrs.append(bech32_encode('bcrt', [0] + convertbits(pkh, 8, 5)))
+    return (b''.join(eckey.get_bytes() for eckey in eckeys), b''.join(pubkeys),
+            p2pkh_addrs, p2sh_p2wpkh_addrs, p2wpkh_addrs)
+
+def generate_key_pairs(n, seed=None, processes=None, chunk_size=1000):
+    """Generate n key pairs and their addresses
+
+    The keys are derived from seed (a 32-byte string, random if not given),
+    so the same seed always gives the same keys. If processes is set, the
+    keys are generated in chunks of chunk_size over a pool of that many
+    processes. Returns a KeyPairs."""
+    if seed is None:
+        seed = random.getrandbits(256).to_bytes(32, 'big')
+    assert len(seed) == 32
+    chunks = map_chunks(functools.partial(_generate_key_pair_chunk, seed), range(n), processes, chunk_size)
+    return KeyPairs(seed,
+                    b''.join(chunk[0] for chunk in chunks),
+                    b''.join(chunk[1] for chunk in chunks),
+                    [addr for chunk in chunks for addr in chunk[2]],
+                    [addr for chunk in chunks for addr in chunk[3]],
+                    [addr for chunk in chunks for addr in chunk[4]])
+
 def get_multisig(node):
     """Generate a fresh 2-of-3 multisig on node
 
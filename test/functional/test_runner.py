@@ -163,6 +163,7 @@ BASE_SCRIPTS = [
     'p2p_invalid_locator.py',
     'p2p_invalid_block.py',
     'p2p_invalid_messages.py',
+    'p2p_load_generator.py',
     'p2p_invalid_tx.py',
     'feature_assumevalid.py',
     'example_test.py',
@@ -235,6 +236,9 @@ BASE_SCRIPTS = [
     'feature_help.py',
     'feature_shutdown.py',
     'framework_test_script.py',
+    'framework_test_messages.py',
+    'framework_test_mininode.py',
+    'framework_test_key.py',
     # Don't append tests at the end to avoid merge conflicts
     # Put them in a random line within the section that fits their approximate run-time
 ]
@@ -246,6 +250,7 @@ NON_SCRIPTS = [
     # These are python files that live in the functional tests directory, but are not test scripts.
     "combine_logs.py",
     "create_cache.py",
+    "framework_bench.py",
     "test_runner.py",
 ]
 